@@ -10,6 +10,7 @@ const state = {
   currentPaymentId: null,
   currentProduct: null,
   pollTimer: null,
+  events: null,
 };
 
 const randomId = () => {
@@ -19,6 +20,22 @@ const randomId = () => {
   return `${Date.now()}-${Math.random().toString(36).slice(2, 10)}`;
 };
 
+// Identificador estável do visitante: cliques repetidos reaproveitam o mesmo Pix
+const customerRef = () => {
+  const key = "conteudovip_customer_ref";
+  try {
+    let ref = localStorage.getItem(key);
+    if (!ref) {
+      ref = randomId();
+      localStorage.setItem(key, ref);
+    }
+    return ref;
+  } catch (e) {
+    state.customerRef = state.customerRef || randomId();
+    return state.customerRef;
+  }
+};
+
 const grid = document.getElementById("product-grid");
 const template = document.getElementById("product-card-template");
 const loadingIndicator = document.querySelector("[data-loading]");
@@ -138,39 +155,70 @@ const hideModal = () => {
   state.currentProduct = null;
   checkoutContent?.setAttribute("hidden", "");
   checkoutLoading?.removeAttribute("hidden");
+  stopWatching();
+};
+
+const updateStatus = (text) => {
+  if (statusLabel) statusLabel.textContent = text;
+};
+
+function stopWatching() {
   if (state.pollTimer) {
     clearInterval(state.pollTimer);
     state.pollTimer = null;
   }
-};
+  if (state.events) {
+    state.events.close();
+    state.events = null;
+  }
+}
 
-const updateStatus = (text) => {
-  if (statusLabel) statusLabel.textContent = text;
+const handlePaymentStatus = (data) => {
+  if (data.status === "paid") {
+    updateStatus("Pagamento confirmado. Acesso liberado!");
+    if (secretLink) {
+      secretLink.href = data.secret_link;
+      secretLink.textContent = "Abrir conteúdo premium";
+    }
+    secretWrap?.removeAttribute("hidden");
+    stopWatching();
+  } else if (["expired", "canceled", "cancelled", "refunded", "failed"].includes(data.status)) {
+    // Qualquer status final encerra o acompanhamento (o servidor também fecha o stream)
+    updateStatus(
+      ["expired", "canceled"].includes(data.status)
+        ? "Este Pix expirou. Gere um novo para continuar."
+        : "Este Pix foi encerrado. Gere um novo para continuar.",
+    );
+    stopWatching();
+  }
 };
 
 const pollPayment = () => {
   if (!state.currentPaymentId) return;
-  fetch(`${API_BASE_URL}/payments/${state.currentPaymentId}`)
+  fetch(`${API_BASE_URL}/payments/${state.currentPaymentId}?view=status`)
       .then((res) => res.json())
-      .then((data) => {
-        if (data.status === "paid") {
-          updateStatus("Pagamento confirmado. Acesso liberado!");
-          if (secretLink) {
-            secretLink.href = data.secret_link;
-            secretLink.textContent = "Abrir conteúdo premium";
-          }
-          secretWrap?.removeAttribute("hidden");
-          if (state.pollTimer) {
-            clearInterval(state.pollTimer);
-            state.pollTimer = null;
-          }
-        }
-      })
+      .then(handlePaymentStatus)
       .catch(() => {});
 };
 
 const startPolling = () => {
-  if (state.pollTimer) clearInterval(state.pollTimer);
+  stopWatching();
+  // Stream SSE: o servidor avisa na hora em que o pagamento muda
+  if (window.EventSource) {
+    const events = new EventSource(`${API_BASE_URL}/payments/${state.currentPaymentId}/events`);
+    state.events = events;
+    events.addEventListener("status", (event) => handlePaymentStatus(JSON.parse(event.data)));
+    // Fim explícito: fecha em vez de deixar o navegador reconectar
+    events.addEventListener("end", stopWatching);
+    events.onerror = () => {
+      // Erros de rede o navegador reconecta sozinho; fechado de vez, volta ao polling
+      if (events.readyState === EventSource.CLOSED && state.events === events) {
+        state.events = null;
+        state.pollTimer = setInterval(pollPayment, 4000);
+      }
+    };
+    return;
+  }
   state.pollTimer = setInterval(pollPayment, 4000);
 };
 
@@ -198,10 +246,12 @@ const requestCheckout = async (product) => {
   updateStatus("Gerando Pix seguro...");
 
   try {
+    const ref = customerRef();
     const response = await fetch(`${API_BASE_URL}/checkout`, {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ product_id: product.product_id, customer_ref: randomId() }),
+      // Mesma chave em cliques repetidos: a API devolve o mesmo Pix
+      headers: { "Content-Type": "application/json", "Idempotency-Key": ref },
+      body: JSON.stringify({ product_id: product.product_id, customer_ref: ref }),
     });
     if (!response.ok) {
       throw new Error(await response.text());
@@ -0,0 +1,109 @@
+"""Controle de admissão do /checkout.
+
+Cada checkout vira uma chamada ao gateway e uma gravação em disco, então
+um cliente automatizado consegue gastar a cota da PushinPay sozinho. Aqui:
+
+- `ClientLimiter`: um token bucket (o mesmo de resilience.py) por chave de
+  cliente (IP e `customer_ref`); estourou, 429 com `Retry-After`.
+- `ConcurrencyLimit`: teto de checkouts em andamento no processo;
+  lotou, 503 com `Retry-After` em vez de enfileirar no pool de threads.
+
+Os contadores aparecem em `/health`.
+"""
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator
+
+from config import settings
+from resilience import GatewayUnavailableError, RateLimitedError, TokenBucket
+
+
+class OverloadedError(GatewayUnavailableError):
+  pass
+
+
+class ClientLimiter:
+  def __init__(
+      self,
+      rate_per_minute: float = settings.checkout_rate_per_minute,
+      burst: float = settings.checkout_burst,
+      max_clients: int = settings.rate_limit_max_clients,
+  ):
+    self.rate = rate_per_minute / 60
+    self.burst = burst
+    self.max_clients = max_clients
+    # LRU: clientes que somem deixam de ocupar memória
+    self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+    self._lock = threading.Lock()
+    self.rejected = 0
+
+  def _bucket(self, key: str) -> TokenBucket:
+    with self._lock:
+      bucket = self._buckets.get(key)
+      if bucket is None:
+        bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+        while len(self._buckets) > self.max_clients:
+          self._buckets.popitem(last=False)
+      else:
+        self._buckets.move_to_end(key)
+      return bucket
+
+  def check(self, *keys: str):
+    """Consome um token de cada chave; se alguma estiver sem token, de nenhuma (`RateLimitedError`)."""
+    reserved = []
+    try:
+      for key in keys:
+        bucket = self._bucket(key)
+        bucket.reserve(0)
+        reserved.append(bucket)
+    except RateLimitedError as exc:
+      # Uma chave estourou: as outras não pagam pela tentativa recusada
+      for bucket in reserved:
+        bucket.refund()
+      with self._lock:
+        self.rejected += 1
+      raise RateLimitedError("Muitas tentativas de checkout; aguarde um pouco", exc.retry_after) from None
+
+  def snapshot(self) -> dict:
+    with self._lock:
+      return {
+          "clients": len(self._buckets),
+          "rejected": self.rejected,
+          "rate_per_minute": round(self.rate * 60, 2),
+          "burst": self.burst,
+      }
+
+
+class ConcurrencyLimit:
+  def __init__(self, limit: int = settings.checkout_max_inflight):
+    self.limit = limit
+    self.in_flight = 0
+    self.peak = 0
+    self.rejected = 0
+    self._lock = threading.Lock()
+
+  @contextmanager
+  def slot(self) -> Iterator[None]:
+    """Ocupa uma vaga sem esperar; sem vaga, sobe `OverloadedError`."""
+    with self._lock:
+      if self.limit > 0 and self.in_flight >= self.limit:
+        self.rejected += 1
+        raise OverloadedError("Muitos checkouts em andamento; tente novamente", 1.0)
+      self.in_flight += 1
+      self.peak = max(self.peak, self.in_flight)
+    try:
+      yield
+    finally:
+      with self._lock:
+        self.in_flight -= 1
+
+  def snapshot(self) -> dict:
+    with self._lock:
+      return {"in_flight": self.in_flight, "limit": self.limit, "peak": self.peak, "rejected": self.rejected}
+
+
+checkout_limiter = ClientLimiter()
+checkout_slots = ConcurrencyLimit()
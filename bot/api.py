@@ -1,18 +1,37 @@
 from __future__ import annotations
 
-import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import time
 from dataclasses import asdict
 from datetime import datetime
 from typing import Optional, List
+from urllib.parse import parse_qs
 from uuid import uuid4
 
-from fastapi import FastAPI, HTTPException, Header, Depends
+from fastapi import FastAPI, HTTPException, Header, Depends, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
 
 from config import settings
-from storage import store, Product, Payment
-from pushinpay import pushinpay_client
+from storage import astore, start_compactor, Product, Payment, TERMINAL_STATUSES
+from blobs import load_qr
+import reconcile
+from pushinpay import async_pushinpay_client
+from admission import OverloadedError, checkout_limiter, checkout_slots
+from charge_pool import pool as charge_pool
+from gateways import PixCharge, normalize_status, render_qr, router
+from idempotency import checkouts
+from http_cache import accepts_gzip, catalog_cache, etag_matches, http_date, not_modified_since, strong_etag
+from payment_events import payment_watchers
+from qr import qr_renderer
+from syncpay import async_syncpay_client, syncpay_client, syncpay_tokens
+from resilience import GatewayUnavailableError, RateLimitedError, pushinpay_guard, syncpay_guard
+import httpx
 import requests
 
 app = FastAPI(title="Telegram Secrets Backend")
@@ -97,27 +116,59 @@ def root():
       "health": "/health",
       "products": "/products",
       "checkout": "/checkout (POST)",
-      "payment_status": "/payments/{payment_id}"
+      "payment_status": "/payments/{payment_id}",
+      "payment_events": "/payments/{payment_id}/events (SSE)",
+      "pushinpay_webhook": "/webhooks/pushinpay (POST)"
     }
   }
 
 
 @app.get("/health")
 def health():
-  return {"status": "ok", "time": datetime.utcnow().isoformat()}
+  return {
+    "status": "ok",
+    "time": datetime.utcnow().isoformat(),
+    "gateways": {
+      # Todo o tráfego dos gateways passa pelos clientes httpx
+      "pushinpay": {"connections": async_pushinpay_client.connection_stats(), **pushinpay_guard.snapshot()},
+      "syncpay": {
+        "connections": async_syncpay_client.connection_stats(),
+        # requests.Session que ainda renova o token (SyncPayTokenManager)
+        "token_connections": syncpay_client.connection_stats(),
+        **syncpay_guard.snapshot(),
+      },
+    },
+    "routing": router.snapshot(),
+    "charge_pool": charge_pool.snapshot(),
+    "payment_streams": payment_watchers.count(),
+    "checkout_dedup": checkouts.snapshot(),
+    "admission": {"rate_limit": checkout_limiter.snapshot(), "in_flight": checkout_slots.snapshot()},
+    "reconciliation": {
+      "leader": reconcile.engine.is_leader,
+      "last_sweep": reconcile.last_report.summary() if reconcile.last_report else None,
+    },
+  }
 
 
 @app.get("/products")
-def list_products():
-  """Lista todos os produtos disponíveis"""
+async def list_products(
+    if_none_match: Optional[str] = Header(default=None),
+    accept_encoding: Optional[str] = Header(default=None),
+):
+  """Lista todos os produtos disponíveis (JSON pré-serializado, com ETag)"""
   try:
-    products = store.list_products()
-    result = [asdict(product) for product in products]
-    # Log para debug
-    import logging
-    log = logging.getLogger(__name__)
-    log.info(f"Listando produtos: {len(result)} encontrado(s)")
-    return result
+    cached = await catalog_cache.get()
+    use_gzip = cached.gzip_body is not None and accepts_gzip(accept_encoding)
+    headers = {
+        "ETag": cached.gzip_etag if use_gzip else cached.etag,
+        "Cache-Control": f"public, max-age={settings.catalog_max_age}",
+        "Vary": "Accept-Encoding",
+    }
+    if cached.matches(if_none_match):
+      return Response(status_code=304, headers=headers)
+    if use_gzip:
+      return Response(cached.gzip_body, media_type="application/json", headers={**headers, "Content-Encoding": "gzip"})
+    return Response(cached.body, media_type="application/json", headers=headers)
   except Exception as e:
     import logging
     log = logging.getLogger(__name__)
@@ -126,46 +177,50 @@ def list_products():
 
 
 @app.post("/products", dependencies=[Depends(require_admin)])
-def create_product(payload: ProductPayload):
+async def create_product(payload: ProductPayload):
   product = Product(**payload.dict())
-  store.save_product(product)
+  await astore.save_product(product)
   return {"status": "saved"}
 
 
 @app.delete("/products/{product_id}", dependencies=[Depends(require_admin)])
-def delete_product(product_id: str):
-  store.delete_product(product_id)
+async def delete_product(product_id: str):
+  await astore.delete_product(product_id)
   return {"status": "removed"}
 
 
-@app.post("/checkout", response_model=CheckoutResponse)
-def create_checkout(payload: CheckoutRequest):
-  product = store.get_product(payload.product_id)
-  if not product:
-    raise HTTPException(status_code=404, detail="Produto não encontrado.")
+def _retry_after(exc: GatewayUnavailableError) -> dict:
+  return {"Retry-After": str(max(1, int(exc.retry_after + 0.999)))}
 
-  payment_id = f"{product.product_id}-{uuid4().hex[:8]}"
-  customer_ref = payload.customer_ref or uuid4().hex
 
+async def _create_charge(product: Product, payment_id: str) -> PixCharge:
+  """Cria o Pix no gateway, traduzindo as falhas em respostas HTTP"""
   try:
-    pix = pushinpay_client.create_pix(
+    # Vai para o gateway mais saudável no momento (ver gateways.router)
+    charge = await router.create_charge(
         amount=product.price,
         description=product.description,
         reference_id=payment_id,
     )
+  except GatewayUnavailableError as exc:
+    # Circuito aberto ou limite de chamadas: falha na hora em vez de esperar o timeout
+    raise HTTPException(
+        status_code=503,
+        detail=f"Gateway de pagamento indisponível no momento: {exc}",
+        headers=_retry_after(exc),
+    ) from exc
   except ValueError as exc:
     # Erro de configuração (credenciais faltando)
-    raise HTTPException(status_code=500, detail=f"Configuração PushinPay inválida: {exc}") from exc
-  except requests.exceptions.HTTPError as exc:
-    # Erro HTTP da API PushinPay
+    raise HTTPException(status_code=500, detail=f"Configuração do gateway inválida: {exc}") from exc
+  except (requests.exceptions.HTTPError, httpx.HTTPStatusError) as exc:
+    # Erro HTTP da API do gateway
     error_detail = f"Erro ao gerar Pix: {exc}"
     if exc.response is not None:
       status_code = exc.response.status_code
       if status_code == 404:
         error_detail = (
-          f"Endpoint PushinPay não encontrado (404). "
-          f"Verifique se a URL está correta no arquivo .env: {settings.pushinpay_base_url}. "
-          f"URL padrão: https://api.pushinpay.com.br"
+          f"Endpoint do gateway não encontrado (404): {exc.request.url}. "
+          f"Verifique se a URL está correta no arquivo .env."
         )
       else:
         try:
@@ -176,21 +231,73 @@ def create_checkout(payload: CheckoutRequest):
     raise HTTPException(status_code=502, detail=error_detail) from exc
   except Exception as exc:
     raise HTTPException(status_code=502, detail=f"Erro ao gerar Pix: {exc}") from exc
+  return charge
 
-  # PushinPay retorna: { "id", "qr_code", "status", "value", "qr_code_base64", ... }
-  # Baseado na documentação oficial: https://app.theneo.io/pushinpay/pix/pix/criar-pix
-  pix_code = pix.get("qr_code") or ""
-  
-  if not pix_code:
-    raise HTTPException(status_code=502, detail="Gateway não retornou o código Pix.")
-
-  # PushinPay retorna qr_code_base64 diretamente
-  # Pode vir como "qr_code_base64" ou "qrCodeBase64" ou precisamos gerar
-  qr_base64 = (
-      pix.get("qr_code_base64")
-      or pix.get("qrCodeBase64")
-      or pushinpay_client.generate_qr_base64(pix_code)
-  )
+
+def _client_ip(request: Request) -> str:
+  # Atrás de proxy (TRUST_FORWARDED_FOR), o IP real é o último do X-Forwarded-For:
+  # o proxy acrescenta o endereço que viu à direita; o resto vem do cliente
+  if settings.trust_forwarded_for:
+    forwarded = request.headers.get("x-forwarded-for", "").split(",")[-1].strip()
+    if forwarded:
+      return forwarded
+  return request.client.host if request.client else "desconhecido"
+
+
+def _admit_checkout(client_ip: str, customer_ref: Optional[str]):
+  """Limite por cliente: um bucket por IP e outro por customer_ref"""
+  keys = [f"ip:{client_ip}"] + ([f"ref:{customer_ref}"] if customer_ref else [])
+  try:
+    checkout_limiter.check(*keys)
+  except RateLimitedError as exc:
+    raise HTTPException(status_code=429, detail=str(exc), headers=_retry_after(exc)) from exc
+
+
+@app.post("/checkout", response_model=CheckoutResponse)
+async def create_checkout(
+    payload: CheckoutRequest,
+    request: Request,
+    idempotency_key: Optional[str] = Header(default=None),
+):
+  customer_ref = payload.customer_ref or uuid4().hex
+  client_ip = _client_ip(request)
+
+  async def issue() -> CheckoutResponse:
+    # Só quem não caiu no cache de idempotência gasta o limite do cliente,
+    # e isso antes de tocar no armazenamento ou no gateway
+    _admit_checkout(client_ip, payload.customer_ref)
+    product = await astore.get_product(payload.product_id)
+    if not product:
+      raise HTTPException(status_code=404, detail="Produto não encontrado.")
+    return await _admitted_checkout(product, customer_ref)
+
+  # Cliques repetidos (mesma Idempotency-Key, ou mesmo customer_ref) recebem o mesmo Pix
+  key = idempotency_key or payload.customer_ref
+  return await checkouts.run(f"checkout:{payload.product_id}:{key}" if key else None, issue)
+
+
+async def _admitted_checkout(product: Product, customer_ref: str) -> CheckoutResponse:
+  # Teto global de checkouts em andamento (CHECKOUT_MAX_INFLIGHT): lotado, 503 na hora
+  try:
+    with checkout_slots.slot():
+      return await _issue_checkout(product, customer_ref)
+  except OverloadedError as exc:
+    raise HTTPException(status_code=503, detail=str(exc), headers=_retry_after(exc)) from exc
+
+
+async def _issue_checkout(product: Product, customer_ref: str) -> CheckoutResponse:
+  # Pix pré-criado (CHARGE_POOL_SIZES) evita esperar o gateway
+  pooled = charge_pool.take(product)
+  if pooled:
+    payment_id, charge, qr_base64 = pooled.payment_id, pooled.charge, pooled.qr_base64
+  else:
+    payment_id = f"{product.product_id}-{uuid4().hex[:8]}"
+    charge = await _create_charge(product, payment_id)
+    if not charge.pix_code:
+      raise HTTPException(status_code=502, detail="Gateway não retornou o código Pix.")
+    # Nem todo gateway devolve a imagem pronta; nesse caso geramos aqui
+    qr_base64 = charge.qr_base64 or await render_qr(charge.pix_code)
+  pix_code = charge.pix_code
   
   # Log para debug
   import logging
@@ -209,11 +316,14 @@ def create_checkout(payload: CheckoutRequest):
       status="pending",
       created_at=datetime.utcnow().isoformat(),
       updated_at=datetime.utcnow().isoformat(),
-      # PushinPay retorna "id" como identificador único da transação
-      syncpay_id=pix.get("id") or payment_id,
+      # Id da transação no gateway que emitiu o Pix
+      syncpay_id=charge.transaction_id,
       secret_link=product.secret_link,
+      gateway=charge.gateway,
   )
-  store.save_payment(payment)
+  await astore.save_payment(payment)
+  # Só responde depois que o pagamento estiver gravado no disco
+  await astore.flush()
 
   return CheckoutResponse(
       payment_id=payment.payment_id,
@@ -228,41 +338,203 @@ def create_checkout(payload: CheckoutRequest):
   )
 
 
+def _status_view(payment: Payment) -> dict:
+  """Só o que quem acompanha o pagamento precisa (sem Pix nem QR Code)"""
+  data = {"payment_id": payment.payment_id, "status": payment.status, "updated_at": payment.updated_at}
+  if payment.status == "paid":
+    data["secret_link"] = payment.secret_link
+  return data
+
+
+def _status_response(payment: Payment, if_none_match: Optional[str], if_modified_since: Optional[str]) -> Response:
+  body = json.dumps(_status_view(payment), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+  headers = {"ETag": strong_etag(body)}
+  last_modified = http_date(payment.updated_at)
+  if last_modified:
+    headers["Last-Modified"] = last_modified
+  if payment.status == "paid":
+    # Pago não volta atrás: o navegador pode guardar a resposta (com o link) de vez
+    headers["Cache-Control"] = "private, max-age=31536000, immutable"
+  else:
+    headers["Cache-Control"] = "no-cache"
+  # If-None-Match tem prioridade; If-Modified-Since só vale sem ele (RFC 9110)
+  if if_none_match is not None:
+    fresh = etag_matches(if_none_match, headers["ETag"])
+  else:
+    fresh = not_modified_since(if_modified_since, last_modified)
+  if fresh:
+    return Response(status_code=304, headers=headers)
+  return Response(body, media_type="application/json", headers=headers)
+
+
 @app.get("/payments/{payment_id}")
-def payment_status(payment_id: str):
-  payment = store.get_payment(payment_id)
+async def payment_status(
+    payment_id: str,
+    include_qr: bool = False,
+    view: Optional[str] = None,
+    if_none_match: Optional[str] = Header(default=None),
+    if_modified_since: Optional[str] = Header(default=None),
+):
+  payment = await astore.get_payment(payment_id)
   if not payment:
     raise HTTPException(status_code=404, detail="Pagamento não encontrado.")
-  response = payment.__dict__.copy()
+  if view == "status":
+    # ?view=status: resposta enxuta para polling, com ETag/Last-Modified e 304
+    return _status_response(payment, if_none_match, if_modified_since)
+  response = asdict(payment)
+  response.pop("qr_ref", None)
+  # A imagem do QR Code fica no blob store e só é lida quando pedida (?include_qr=true)
+  response["qr_base64"] = await run_in_threadpool(load_qr, payment) if include_qr else None
   if payment.status != "paid":
     response.pop("secret_link", None)
   return response
 
 
+def _sse(event: str, data: dict, event_id: Optional[str] = None) -> str:
+  # `id` volta no Last-Event-ID quando o navegador reconecta
+  prefix = f"id: {event_id}\n" if event_id else ""
+  return f"{prefix}event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _status_stream(request: Request, payment_id: str, watcher):
+  # O navegador reconecta sozinho (EventSource) quando o stream termina por tempo
+  yield "retry: 3000\n\n"
+  payment = await astore.get_payment(payment_id)
+  status = payment.status if payment else None
+  if payment:
+    yield _sse("status", _status_view(payment), payment.status)
+  deadline = time.monotonic() + settings.sse_max_seconds
+  while payment and status not in TERMINAL_STATUSES and time.monotonic() < deadline:
+    notified = await watcher.wait(settings.sse_keepalive)
+    if await request.is_disconnected():
+      return
+    # Sem aviso também relê: pega mudanças gravadas por outro processo (ex.: expirado)
+    payment = await astore.get_payment(payment_id)
+    if payment and payment.status != status:
+      status = payment.status
+      yield _sse("status", _status_view(payment), status)
+    elif notified is None:
+      yield ": keepalive\n\n"
+  if status in TERMINAL_STATUSES:
+    # Fim de verdade: a página fecha o EventSource em vez de reconectar
+    yield _sse("end", {"status": status})
+
+
+@app.get("/payments/{payment_id}/events")
+async def payment_events(payment_id: str, request: Request):
+  """Stream SSE com o status do pagamento: avisa na hora em que ele muda"""
+  payment = await astore.get_payment(payment_id)
+  if not payment:
+    raise HTTPException(status_code=404, detail="Pagamento não encontrado.")
+  # Reconexão de quem já recebeu o status final: 204 faz o EventSource parar de tentar
+  if payment.status in TERMINAL_STATUSES and request.headers.get("last-event-id") == payment.status:
+    return Response(status_code=204)
+
+  async def stream():
+    with payment_watchers.watch(payment_id) as watcher:
+      async for chunk in _status_stream(request, payment_id, watcher):
+        yield chunk
+
+  return StreamingResponse(
+      stream(),
+      media_type="text/event-stream",
+      # Sem buffer em proxies (nginx) para o evento sair na hora
+      headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+  )
+
+
+@app.get("/payments/{payment_id}/qr.svg")
+async def payment_qr_svg(payment_id: str):
+  """QR Code vetorial do pagamento (bem mais leve que o PNG depois de comprimido)"""
+  payment = await astore.get_payment(payment_id)
+  if not payment or not payment.pix_code:
+    raise HTTPException(status_code=404, detail="Pagamento não encontrado.")
+  svg = await run_in_threadpool(qr_renderer.svg, payment.pix_code)
+  # O código Pix de um pagamento nunca muda
+  return Response(svg, media_type="image/svg+xml", headers={"Cache-Control": "public, max-age=86400, immutable"})
+
+
+def _pushinpay_webhook_authorized(request: Request, body: bytes, token: Optional[str]) -> bool:
+  """Confere o segredo compartilhado: `?token=` da URL ou HMAC-SHA256 do corpo"""
+  secret = settings.pushinpay_webhook_secret
+  if not secret:
+    # Sem segredo não há como distinguir a PushinPay de qualquer um
+    return False
+  if token and hmac.compare_digest(token, secret):
+    return True
+  signature = request.headers.get("X-Signature") or request.headers.get("X-PushinPay-Signature")
+  if signature:
+    expected = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(signature.strip().lower().removeprefix("sha256="), expected)
+  return False
+
+
+@app.post("/webhooks/pushinpay")
+async def pushinpay_webhook(request: Request, token: Optional[str] = None):
+  """Callback da PushinPay: confirma o pagamento sem esperar o polling"""
+  body = await request.body()
+  if not _pushinpay_webhook_authorized(request, body, token):
+    raise HTTPException(status_code=403, detail="Unauthorized")
+
+  # PushinPay envia form-urlencoded (id, status, value...); aceitamos JSON também
+  if "json" in request.headers.get("content-type", ""):
+    try:
+      data = json.loads(body or b"{}")
+    except json.JSONDecodeError:
+      raise HTTPException(status_code=400, detail="JSON inválido")
+  else:
+    data = {key: values[-1] for key, values in parse_qs(body.decode("utf-8", "replace")).items()}
+
+  transaction_id = str(data.get("id") or data.get("transaction_id") or "")
+  status = str(data.get("status") or "").lower()
+  if not transaction_id or not status:
+    raise HTTPException(status_code=400, detail="Payload sem id/status")
+
+  payment = await astore.get_payment_by_gateway_id(transaction_id)
+  if not payment:
+    logging.getLogger(__name__).warning("Webhook PushinPay para transação desconhecida: %s", transaction_id)
+    return {"status": "ignored"}
+
+  # PushinPay retorna: "created" | "paid" | "canceled"
+  if status not in ("paid", "canceled") or payment.status in TERMINAL_STATUSES:
+    return {"status": "received"}
+
+  # O webhook só avisa; o status que vale é o que o gateway responde
+  try:
+    confirmed = await router.fetch_status(payment)
+  except GatewayUnavailableError as exc:
+    raise HTTPException(status_code=503, detail=str(exc), headers=_retry_after(exc)) from exc
+  except Exception as exc:
+    raise HTTPException(status_code=502, detail=f"Erro ao confirmar pagamento: {exc}") from exc
+  if confirmed in ("paid", "canceled", "refunded", "expired") and payment.status != confirmed:
+    await astore.update_payment_status(payment.payment_id, confirmed)
+    await astore.flush()
+  return {"status": "received"}
+
+
 @app.post("/webhooks/syncpay")
-def syncpay_webhook(payload: WebhookPayload):
-  status = payload.status.lower()
-  store.update_payment_status(payload.reference_id, status)
+async def syncpay_webhook(payload: WebhookPayload):
+  status = normalize_status(payload.status)
+  await astore.update_payment_status(payload.reference_id, status)
+  await astore.flush()
   return {"status": "received"}
 
 
-async def monitor_payments():
-  while True:
-    await asyncio.sleep(25)
-    pending = store.find_pending_payments()
-    for payment in pending:
-      try:
-        data = pushinpay_client.get_transaction(payment.syncpay_id or payment.payment_id)
-      except Exception:
-        continue
-      # PushinPay retorna: "created" | "paid" | "canceled"
-      status = data.get("status", "").lower()
-      if status == "paid":
-        store.update_payment_status(payment.payment_id, "paid")
+async def on_payment_paid(payment: Payment):
+  logging.getLogger(__name__).info("Pagamento %s confirmado (%s)", payment.payment_id, payment.product_title)
+  # Confirmações gravadas por outro processo também acordam os streams abertos aqui
+  payment_watchers.notify(payment.payment_id, "paid")
 
 
 @app.on_event("startup")
 async def on_start():
-  if not getattr(app.state, "monitor_task", None):
-    app.state.monitor_task = asyncio.create_task(monitor_payments())
+  # Compactação do journal de pagamentos (fica fora do import do storage)
+  start_compactor()
+  # O polling do gateway fica no reconcile.engine (um único líder entre processos)
+  reconcile.engine.subscribe(on_payment_paid)
+  reconcile.engine.start()
+  # Busca o token SyncPay antes da primeira requisição e o mantém renovado
+  syncpay_tokens.start()
+  # Reposição do pool de Pix pré-criados (só com CHARGE_POOL_SIZES)
+  charge_pool.start()
 
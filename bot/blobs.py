@@ -0,0 +1,80 @@
+"""Armazenamento de imagens de QR Code fora dos registros de pagamento.
+
+As imagens ficam em `data/qr/<sha256 do pix_code>.png` e o `Payment` guarda
+só a referência (`qr_ref`). Como a chave é o hash do código Pix, o mesmo
+código nunca é gravado duas vezes.
+"""
+from __future__ import annotations
+
+import base64
+import binascii
+import hashlib
+import logging
+import os
+from dataclasses import replace
+from pathlib import Path
+from typing import Optional, TYPE_CHECKING
+
+from config import settings
+
+if TYPE_CHECKING:
+  from storage import Payment
+
+log = logging.getLogger(__name__)
+
+
+class BlobStore:
+  def __init__(self, base_dir: Path = settings.data_dir / "qr"):
+    self.base_dir = base_dir
+    self.base_dir.mkdir(parents=True, exist_ok=True)
+
+  @staticmethod
+  def key_for(pix_code: str) -> str:
+    return hashlib.sha256(pix_code.encode("utf-8")).hexdigest()
+
+  def _path(self, key: str) -> Path:
+    return self.base_dir / f"{key}.png"
+
+  def put(self, key: str, qr_base64: str) -> str:
+    """Grava a imagem (se ainda não existir) e devolve a chave."""
+    path = self._path(key)
+    if path.exists():
+      return key
+    # Remove prefixo "data:image/png;base64," se vier do gateway
+    if qr_base64.startswith("data:"):
+      qr_base64 = qr_base64.split(",", 1)[-1]
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_bytes(base64.b64decode(qr_base64))
+    os.replace(tmp_path, path)
+    return key
+
+  def get(self, key: str) -> Optional[str]:
+    """Devolve a imagem em base64, ou None se a chave não existir."""
+    try:
+      return base64.b64encode(self._path(key).read_bytes()).decode("utf-8")
+    except FileNotFoundError:
+      return None
+
+
+qr_blobs = BlobStore()
+
+
+def externalize_qr(payment: Payment) -> Payment:
+  """Move o `qr_base64` do pagamento para o blob store, deixando só `qr_ref`."""
+  if not payment.qr_base64 or not payment.pix_code:
+    return payment
+  try:
+    key = qr_blobs.put(BlobStore.key_for(payment.pix_code), payment.qr_base64)
+  except (OSError, ValueError, binascii.Error) as e:
+    log.warning(f"Não foi possível gravar QR Code de {payment.payment_id} fora do registro: {e}")
+    return payment
+  return replace(payment, qr_base64=None, qr_ref=key)
+
+
+def load_qr(payment: Payment) -> Optional[str]:
+  """Carrega a imagem do QR Code de um pagamento (inline nos registros antigos)."""
+  if payment.qr_base64:
+    return payment.qr_base64
+  if payment.qr_ref:
+    return qr_blobs.get(payment.qr_ref)
+  return None
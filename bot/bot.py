@@ -14,8 +14,11 @@ from telegram import Update
 from telegram.ext import Application, CommandHandler, ContextTypes, ConversationHandler, MessageHandler, filters
 
 from config import settings
-from storage import store, Product, Payment
-from pushinpay import pushinpay_client
+from storage import astore, start_compactor, Product, Payment
+from charge_pool import pool as charge_pool
+from gateways import render_qr, router
+from idempotency import checkouts
+import reconcile
 from pathlib import Path
 
 # Importa a API para iniciá-la junto com o bot
@@ -82,7 +85,7 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def cmd_produtos(update: Update, context: ContextTypes.DEFAULT_TYPE):
-  products = store.list_products()
+  products = await astore.list_products()
   if not products:
     await update.message.reply_text("Nenhum produto cadastrado.")
     return
@@ -301,7 +304,7 @@ async def receive_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
         category="Premium",
     )
     
-    store.save_product(product)
+    await astore.save_product(product)
     
     # Gera página HTML estática para o produto
     page_info = ""
@@ -320,7 +323,7 @@ async def receive_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
         import json
         project_root = Path(__file__).parent.parent
         json_file = project_root / "products.json"
-        products = store.list_products()
+        products = await astore.list_products()
         products_data = []
         for p in products:
             products_data.append({
@@ -392,18 +395,19 @@ async def cmd_del_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
   if not context.args:
     return await update.message.reply_text("Use /delproduct <produto_id>")
   product_id = context.args[0]
-  store.delete_product(product_id)
+  await astore.delete_product(product_id)
   await update.message.reply_text(f"Produto '{product_id}' removido (se existia).")
 
 
 async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
   if not is_admin(update.effective_user.id if update.effective_user else None):
     return await reply_admin_only(update)
-  products = store.list_products()
-  payments = store.list_payments()
-  pending = sum(1 for p in payments if p.status == "pending")
-  paid = sum(1 for p in payments if p.status == "paid")
-  total_revenue = sum(p.price for p in payments if p.status == "paid")
+  products = await astore.list_products()
+  # Só status e preço: não carrega pix_code/QR/link de cada pagamento
+  payments = await astore.project_payments("status", "price")
+  pending = sum(1 for status, _ in payments if status == "pending")
+  paid = sum(1 for status, _ in payments if status == "paid")
+  total_revenue = sum(price or 0 for status, price in payments if status == "paid")
   await update.message.reply_text(
       f"Produtos: {len(products)}\n"
       f"Pagamentos pendentes: {pending}\n"
@@ -412,6 +416,42 @@ async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
   )
 
 
+async def issue_pix(product: Product, customer_id: int) -> Payment:
+  """Cria (ou tira do pool) o Pix do produto e grava o pagamento"""
+  # Pix pré-criado (CHARGE_POOL_SIZES) evita esperar o gateway
+  pooled = charge_pool.take(product)
+  if pooled:
+    payment_id, charge = pooled.payment_id, pooled.charge
+  else:
+    payment_id = f"{product.product_id}-{uuid4().hex[:8]}"
+    charge = await router.create_charge(product.price, product.description, payment_id)
+    if not charge.pix_code:
+      raise ValueError("Gateway não retornou código Pix.")
+  # A foto vai para o Telegram: sempre o PNG normal, independente do QR_FORMAT do site
+  qr_base64 = charge.qr_base64 or await render_qr(charge.pix_code, "png")
+
+  payment = Payment(
+      payment_id=payment_id,
+      product_id=product.product_id,
+      product_title=product.title,
+      customer_id=customer_id,
+      customer_ref=str(customer_id or uuid4()),
+      price=product.price,
+      pix_code=charge.pix_code,
+      qr_base64=qr_base64,
+      status="pending",
+      created_at=datetime.utcnow().isoformat(),
+      updated_at=datetime.utcnow().isoformat(),
+      # Id da transação no gateway que emitiu o Pix
+      syncpay_id=charge.transaction_id,
+      secret_link=product.secret_link or settings.secret_access_url,
+      gateway=charge.gateway,
+  )
+  await astore.save_payment(payment)
+  await astore.flush()
+  return payment
+
+
 async def cmd_pix(update: Update, context: ContextTypes.DEFAULT_TYPE):
   """Gera PIX para um produto. Pode ser chamado via /pix <id> ou /start pix-<id>"""
   product_id = None
@@ -435,7 +475,7 @@ async def cmd_pix(update: Update, context: ContextTypes.DEFAULT_TYPE):
       parse_mode="Markdown"
     )
   
-  product = store.get_product(product_id)
+  product = await astore.get_product(product_id)
   if not product:
     return await update.message.reply_text(
       f"❌ Produto `{product_id}` não encontrado.\n\n"
@@ -444,39 +484,17 @@ async def cmd_pix(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
   customer_id = update.effective_user.id if update.effective_user else 0
-  payment_id = f"{product.product_id}-{uuid4().hex[:8]}"
   try:
-    pix = pushinpay_client.create_pix(product.price, product.description, payment_id)
+    # /pix repetido pelo mesmo usuário reaproveita o Pix em vez de criar outro
+    payment = await checkouts.run(
+        f"pix:{product.product_id}:{customer_id}" if customer_id else None,
+        lambda: issue_pix(product, customer_id),
+    )
   except Exception as exc:
     log.exception("Erro ao criar Pix")
     return await update.message.reply_text(f"Erro ao gerar Pix: {exc}")
-
-  # PushinPay retorna: { "id", "qr_code", "status", "value", "qr_code_base64", ... }
-  pix_code = pix.get("qr_code") or ""
-  if not pix_code:
-    return await update.message.reply_text("Gateway não retornou código Pix.")
-  qr_base64 = (
-    pix.get("qr_code_base64") 
-    or pushinpay_client.generate_qr_base64(pix_code)
-  )
-
-  payment = Payment(
-      payment_id=payment_id,
-      product_id=product.product_id,
-      product_title=product.title,
-      customer_id=customer_id,
-      customer_ref=str(customer_id or uuid4()),
-      price=product.price,
-      pix_code=pix_code,
-      qr_base64=qr_base64,
-      status="pending",
-      created_at=datetime.utcnow().isoformat(),
-      updated_at=datetime.utcnow().isoformat(),
-      # PushinPay retorna "id" como identificador único da transação
-      syncpay_id=pix.get("id") or payment_id,
-      secret_link=product.secret_link or settings.secret_access_url,
-  )
-  store.save_payment(payment)
+  pix_code = payment.pix_code
+  qr_base64 = payment.qr_base64
 
   message = (
       f"💳 Pagamento gerado para *{product.title}*\n"
@@ -492,35 +510,26 @@ async def cmd_pix(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_photo(photo=image, caption="Escaneie o QR Code para pagar.")
 
 
-async def payment_monitor(app: Application):
-  pending = store.find_pending_payments()
-  for payment in pending:
-    if not payment.syncpay_id:
-      continue
+async def deliver_link(app: Application, payment: Payment):
+  """Envia o link secreto quando o reconcile.engine avisa que o pagamento foi confirmado"""
+  link = payment.secret_link or settings.secret_access_url
+  if payment.customer_id:
     try:
-      data = pushinpay_client.get_transaction(payment.syncpay_id)
-    except Exception:
-      continue
-    # PushinPay retorna: "created" | "paid" | "canceled"
-    status = data.get("status", "").lower()
-    if status == "paid":
-      store.update_payment_status(payment.payment_id, "paid")
-      link = payment.secret_link or settings.secret_access_url
-      if payment.customer_id:
-        try:
-          await app.bot.send_message(
-              chat_id=payment.customer_id,
-              text=(
-                  f"✅ Pagamento confirmado para {payment.product_title}!\n"
-                  f"Link liberado: {link}"
-              ),
-          )
-        except Exception as exc:
-          log.warning("Falha ao enviar link para %s: %s", payment.customer_id, exc)
+      await app.bot.send_message(
+          chat_id=payment.customer_id,
+          text=(
+              f"✅ Pagamento confirmado para {payment.product_title}!\n"
+              f"Link liberado: {link}"
+          ),
+      )
+    except Exception as exc:
+      log.warning("Falha ao enviar link para %s: %s", payment.customer_id, exc)
 
 
-async def payment_job(context: ContextTypes.DEFAULT_TYPE):
-  await payment_monitor(context.application)
+async def start_reconciliation(app: Application):
+  """Inscreve a entrega de links no engine (roda no event loop do bot)"""
+  reconcile.engine.subscribe(lambda payment: deliver_link(app, payment))
+  reconcile.engine.start()
 
 
 def start_api_server():
@@ -542,6 +551,8 @@ def main():
   if not settings.telegram_token:
     raise RuntimeError("TELEGRAM_BOT_TOKEN não configurado.")
 
+  start_compactor()
+
   # Inicia a API em uma thread separada
   api_thread = threading.Thread(target=start_api_server, daemon=True)
   api_thread.start()
@@ -551,7 +562,7 @@ def main():
   import time
   time.sleep(2)
 
-  application = Application.builder().token(settings.telegram_token).build()
+  application = Application.builder().token(settings.telegram_token).post_init(start_reconciliation).build()
   
   # Obtém username do bot automaticamente
   async def get_bot_username(context: ContextTypes.DEFAULT_TYPE):
@@ -598,8 +609,6 @@ def main():
   application.add_handler(CommandHandler("delproduct", cmd_del_product))
   application.add_handler(CommandHandler("stats", cmd_stats))
   application.add_handler(CommandHandler("pix", cmd_pix))
-
-  application.job_queue.run_repeating(payment_job, interval=30, first=5)
   
   # Agenda obtenção do username após o bot iniciar
   application.job_queue.run_once(get_bot_username, when=1)
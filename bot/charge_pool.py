@@ -0,0 +1,156 @@
+"""Pool de cobranças Pix pré-criadas por produto (opcional).
+
+Com `CHARGE_POOL_SIZES` (ex.: `vip-pro=3,*=1`), mantém N Pix já criados
+no gateway, com QR Code renderizado, para cada produto. O checkout pega
+um pronto em vez de esperar o `create_pix`, e uma tarefa de fundo repõe
+o pool. Entradas mais velhas que `CHARGE_POOL_MAX_AGE` (ou com preço
+diferente do produto atual) são descartadas antes de alguém recebê-las;
+o Pix descartado simplesmente expira no gateway sem ser pago.
+
+O pool fica em memória, por processo: nada é gravado até o checkout
+transformar a cobrança num `Payment`.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, Optional
+from uuid import uuid4
+
+from config import settings
+from gateways import PixCharge, render_qr, router
+from storage import astore, Product
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class PooledCharge:
+  payment_id: str
+  price: float
+  charge: PixCharge
+  qr_base64: str
+  created_at: float
+
+
+class ChargePool:
+  def __init__(
+      self,
+      sizes: Dict[str, int] = settings.charge_pool_sizes,
+      max_age: float = settings.charge_pool_max_age,
+      interval: float = settings.charge_pool_refill_interval,
+  ):
+    self.sizes = dict(sizes)
+    self.max_age = max_age
+    self.interval = interval
+    self._entries: Dict[str, Deque[PooledCharge]] = {}
+    self._lock = threading.Lock()
+    self._loop: Optional[asyncio.AbstractEventLoop] = None
+    self._wakeup: Optional[asyncio.Event] = None
+    self._task: Optional[asyncio.Task] = None
+    self.hits = 0
+    self.misses = 0
+
+  @property
+  def enabled(self) -> bool:
+    return bool(self.sizes)
+
+  def target(self, product_id: str) -> int:
+    return self.sizes.get(product_id, self.sizes.get("*", 0))
+
+  def _fresh(self, entry: PooledCharge, product: Product, now: float) -> bool:
+    return now - entry.created_at < self.max_age and entry.price == product.price
+
+  def take(self, product: Product) -> Optional[PooledCharge]:
+    """Entrega um Pix pronto para o produto (ou None) e pede a reposição."""
+    if not self.target(product.product_id):
+      return None
+    now = time.monotonic()
+    entry = None
+    with self._lock:
+      queue = self._entries.get(product.product_id)
+      while queue:
+        # O mais antigo primeiro: os novos aguentam mais tempo no pool
+        candidate = queue.popleft()
+        if self._fresh(candidate, product, now):
+          entry = candidate
+          break
+      if entry:
+        self.hits += 1
+      else:
+        self.misses += 1
+    self._wake()
+    return entry
+
+  def _wake(self):
+    if self._loop is not None and self._wakeup is not None:
+      try:
+        self._loop.call_soon_threadsafe(self._wakeup.set)
+      except RuntimeError:
+        # Loop já encerrado
+        pass
+
+  async def _create(self, product: Product):
+    payment_id = f"{product.product_id}-{uuid4().hex[:8]}"
+    charge = await router.create_charge(product.price, product.description, payment_id)
+    if not charge.pix_code:
+      raise ValueError("Gateway não retornou o código Pix")
+    qr_base64 = charge.qr_base64 or await render_qr(charge.pix_code)
+    entry = PooledCharge(payment_id, product.price, charge, qr_base64, time.monotonic())
+    with self._lock:
+      self._entries.setdefault(product.product_id, deque()).append(entry)
+
+  async def refill(self):
+    """Descarta entradas vencidas e completa o pool de cada produto."""
+    products = {product.product_id: product for product in await astore.list_products()}
+    now = time.monotonic()
+    missing = []
+    with self._lock:
+      for product_id in list(self._entries):
+        if product_id not in products:
+          del self._entries[product_id]
+      for product in products.values():
+        queue = self._entries.setdefault(product.product_id, deque())
+        fresh = [entry for entry in queue if self._fresh(entry, product, now)]
+        queue.clear()
+        queue.extend(fresh)
+        missing.extend([product] * max(self.target(product.product_id) - len(queue), 0))
+    if not missing:
+      return
+    results = await asyncio.gather(*(self._create(product) for product in missing), return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+      log.warning("Pool de Pix: %s de %s cobrança(s) não criada(s): %s", len(errors), len(missing), errors[0])
+
+  async def _run(self):
+    while True:
+      try:
+        await self.refill()
+      except Exception:
+        log.exception("Erro ao repor o pool de Pix")
+      try:
+        await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+      except asyncio.TimeoutError:
+        pass
+      self._wakeup.clear()
+
+  def start(self):
+    """Inicia a reposição no event loop atual (idempotente; sem pool não faz nada)."""
+    if not self.enabled or self._task is not None:
+      return
+    self._loop = asyncio.get_running_loop()
+    self._wakeup = asyncio.Event()
+    self._task = self._loop.create_task(self._run())
+    log.info("Pool de Pix ativo: %s", self.sizes)
+
+  def snapshot(self) -> dict:
+    with self._lock:
+      ready = {product_id: len(queue) for product_id, queue in self._entries.items() if queue}
+    return {"enabled": self.enabled, "ready": ready, "hits": self.hits, "misses": self.misses}
+
+
+pool = ChargePool()
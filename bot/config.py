@@ -1,8 +1,8 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List
+from typing import Dict, List
 
 from dotenv import load_dotenv
 import os
@@ -31,6 +31,19 @@ def _csv_to_list(value: str | None) -> List[int]:
   return ids
 
 
+def _pool_sizes(value: str | None) -> Dict[str, int]:
+  """`vip-pro=3,consultoria=1` (ou `*=2` para todos os produtos)"""
+  sizes: Dict[str, int] = {}
+  for chunk in (value or "").split(","):
+    product_id, _, size = chunk.partition("=")
+    try:
+      if product_id.strip() and int(size) > 0:
+        sizes[product_id.strip()] = int(size)
+    except ValueError:
+      continue
+  return sizes
+
+
 @dataclass
 class Settings:
   telegram_token: str
@@ -48,12 +61,61 @@ class Settings:
   admin_api_token: str
   allowed_origins: List[str]
   data_dir: Path = BASE_DIR / "data"
+  storage_backend: str = "json"
+  journal_compact_bytes: int = 1_048_576
+  journal_compact_interval: float = 60.0
+  storage_commit_latency_ms: float = 5.0
+  storage_workers: int = 4
+  gateway_connect_timeout: float = 5.0
+  gateway_read_timeout: float = 20.0
+  gateway_pool_connections: int = 4
+  gateway_pool_maxsize: int = 10
+  reconcile_concurrency: int = 10
+  reconcile_deadline: float = 20.0
+  reconcile_tick: float = 3.0
+  poll_fresh_interval: float = 5.0
+  poll_fresh_window: float = 300.0
+  poll_max_interval: float = 600.0
+  pix_expiry_minutes: float = 60.0
+  pushinpay_webhook_url: str = ""
+  pushinpay_webhook_secret: str = ""
+  webhook_grace_seconds: float = 60.0
+  circuit_failure_threshold: int = 5
+  circuit_reset_timeout: float = 30.0
+  gateway_rate_per_second: float = 10.0
+  gateway_rate_burst: float = 20.0
+  gateway_rate_max_wait: float = 1.0
+  gateway_get_retries: int = 2
+  syncpay_token_refresh_lead: float = 120.0
+  gateway_order: List[str] = field(default_factory=lambda: ["pushinpay", "syncpay"])
+  gateway_stats_window: int = 50
+  charge_pool_sizes: Dict[str, int] = field(default_factory=dict)
+  charge_pool_max_age: float = 600.0
+  charge_pool_refill_interval: float = 5.0
+  qr_format: str = "png"
+  qr_cache_size: int = 512
+  qr_workers: int = 2
+  catalog_cache_ttl: float = 5.0
+  catalog_max_age: int = 30
+  sse_keepalive: float = 15.0
+  sse_max_seconds: float = 300.0
+  idempotency_window: float = 300.0
+  checkout_rate_per_minute: float = 10.0
+  checkout_burst: float = 5.0
+  checkout_max_inflight: int = 32
+  rate_limit_max_clients: int = 10000
+  trust_forwarded_for: bool = False
 
 
 def load_settings() -> Settings:
   data_dir = BASE_DIR / "data"
   data_dir.mkdir(exist_ok=True)
 
+  # Webhook da PushinPay: explícito ou derivado de WEB_BASE_URL (quando configurado)
+  pushinpay_webhook_url = os.getenv("PUSHINPAY_WEBHOOK_URL", "")
+  if not pushinpay_webhook_url and os.getenv("WEB_BASE_URL"):
+    pushinpay_webhook_url = os.getenv("WEB_BASE_URL", "").rstrip("/") + "/webhooks/pushinpay"
+
   return Settings(
       telegram_token=os.getenv("TELEGRAM_BOT_TOKEN", ""),
       telegram_admin_ids=_csv_to_list(os.getenv("TELEGRAM_ADMIN_IDS", "")),
@@ -70,6 +132,50 @@ def load_settings() -> Settings:
       admin_api_token=os.getenv("ADMIN_API_TOKEN", ""),
       allowed_origins=[origin.strip() for origin in os.getenv("ALLOWED_ORIGINS", "*").split(",") if origin.strip()],
       data_dir=data_dir,
+      storage_backend=os.getenv("STORAGE_BACKEND", "json").strip().lower(),
+      journal_compact_bytes=int(os.getenv("JOURNAL_COMPACT_BYTES", "1048576")),
+      journal_compact_interval=float(os.getenv("JOURNAL_COMPACT_INTERVAL", "60")),
+      storage_commit_latency_ms=float(os.getenv("STORAGE_COMMIT_LATENCY_MS", "5")),
+      storage_workers=int(os.getenv("STORAGE_WORKERS", "4")),
+      gateway_connect_timeout=float(os.getenv("GATEWAY_CONNECT_TIMEOUT", "5")),
+      gateway_read_timeout=float(os.getenv("GATEWAY_READ_TIMEOUT", "20")),
+      gateway_pool_connections=int(os.getenv("GATEWAY_POOL_CONNECTIONS", "4")),
+      gateway_pool_maxsize=int(os.getenv("GATEWAY_POOL_MAXSIZE", "10")),
+      reconcile_concurrency=int(os.getenv("RECONCILE_CONCURRENCY", "10")),
+      reconcile_deadline=float(os.getenv("RECONCILE_DEADLINE", "20")),
+      reconcile_tick=float(os.getenv("RECONCILE_TICK", "3")),
+      poll_fresh_interval=float(os.getenv("POLL_FRESH_INTERVAL", "5")),
+      poll_fresh_window=float(os.getenv("POLL_FRESH_WINDOW", "300")),
+      poll_max_interval=float(os.getenv("POLL_MAX_INTERVAL", "600")),
+      pix_expiry_minutes=float(os.getenv("PIX_EXPIRY_MINUTES", "60")),
+      pushinpay_webhook_url=pushinpay_webhook_url,
+      pushinpay_webhook_secret=os.getenv("PUSHINPAY_WEBHOOK_SECRET", ""),
+      webhook_grace_seconds=float(os.getenv("WEBHOOK_GRACE_SECONDS", "60")),
+      circuit_failure_threshold=int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5")),
+      circuit_reset_timeout=float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30")),
+      gateway_rate_per_second=float(os.getenv("GATEWAY_RATE_PER_SECOND", "10")),
+      gateway_rate_burst=float(os.getenv("GATEWAY_RATE_BURST", "20")),
+      gateway_rate_max_wait=float(os.getenv("GATEWAY_RATE_MAX_WAIT", "1")),
+      gateway_get_retries=int(os.getenv("GATEWAY_GET_RETRIES", "2")),
+      syncpay_token_refresh_lead=float(os.getenv("SYNCPAY_TOKEN_REFRESH_LEAD", "120")),
+      gateway_order=[name.strip().lower() for name in os.getenv("GATEWAY_ORDER", "pushinpay,syncpay").split(",") if name.strip()],
+      gateway_stats_window=int(os.getenv("GATEWAY_STATS_WINDOW", "50")),
+      charge_pool_sizes=_pool_sizes(os.getenv("CHARGE_POOL_SIZES", "")),
+      charge_pool_max_age=float(os.getenv("CHARGE_POOL_MAX_AGE", "600")),
+      charge_pool_refill_interval=float(os.getenv("CHARGE_POOL_REFILL_INTERVAL", "5")),
+      qr_format=os.getenv("QR_FORMAT", "png").strip().lower(),
+      qr_cache_size=int(os.getenv("QR_CACHE_SIZE", "512")),
+      qr_workers=int(os.getenv("QR_WORKERS", "2")),
+      catalog_cache_ttl=float(os.getenv("CATALOG_CACHE_TTL", "5")),
+      catalog_max_age=int(os.getenv("CATALOG_MAX_AGE", "30")),
+      sse_keepalive=float(os.getenv("SSE_KEEPALIVE", "15")),
+      sse_max_seconds=float(os.getenv("SSE_MAX_SECONDS", "300")),
+      idempotency_window=float(os.getenv("IDEMPOTENCY_WINDOW", "300")),
+      checkout_rate_per_minute=float(os.getenv("CHECKOUT_RATE_PER_MINUTE", "10")),
+      checkout_burst=float(os.getenv("CHECKOUT_BURST", "5")),
+      checkout_max_inflight=int(os.getenv("CHECKOUT_MAX_INFLIGHT", "32")),
+      rate_limit_max_clients=int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "10000")),
+      trust_forwarded_for=os.getenv("TRUST_FORWARDED_FOR", "false").lower() in ("1", "true", "yes"),
   )
 
 
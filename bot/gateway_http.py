@@ -0,0 +1,118 @@
+"""Sessões HTTP com pool de conexões para os clientes dos gateways Pix.
+
+Cada cliente (PushinPay, SyncPay) tem a sua `requests.Session`, que mantém
+as conexões TCP/TLS abertas (keep-alive) entre chamadas em vez de abrir
+uma nova a cada checkout ou consulta. As variantes assíncronas, por onde
+passa todo o tráfego dos gateways (`gateways.router`), usam um
+`httpx.AsyncClient` por event loop, com o mesmo limite de conexões e os
+mesmos contadores de reuso.
+"""
+from __future__ import annotations
+
+import asyncio
+import socket
+import threading
+import weakref
+from typing import Dict, Tuple
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+from config import settings
+
+# Keep-alive no nível do TCP, para o SO detectar conexões mortas no pool
+SOCKET_OPTIONS = HTTPConnection.default_socket_options + [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
+
+
+class PooledAdapter(HTTPAdapter):
+  """HTTPAdapter com keep-alive de TCP e contadores de reuso de conexão."""
+
+  def init_poolmanager(self, *args, **kwargs):
+    kwargs["socket_options"] = SOCKET_OPTIONS
+    super().init_poolmanager(*args, **kwargs)
+
+  def stats(self) -> Dict[str, int]:
+    pools = self.poolmanager.pools
+    requests_made = connections = 0
+    for key in pools.keys():
+      pool = pools.get(key)
+      if pool is None:
+        continue
+      requests_made += pool.num_requests
+      connections += pool.num_connections
+    return {
+        "requests": requests_made,
+        "connections_opened": connections,
+        "connections_reused": max(requests_made - connections, 0),
+    }
+
+
+def gateway_timeout() -> Tuple[float, float]:
+  """Timeout (conexão, leitura) usado nas chamadas aos gateways."""
+  return (settings.gateway_connect_timeout, settings.gateway_read_timeout)
+
+
+def create_session() -> Tuple[requests.Session, PooledAdapter]:
+  session = requests.Session()
+  adapter = PooledAdapter(
+      pool_connections=settings.gateway_pool_connections,
+      pool_maxsize=settings.gateway_pool_maxsize,
+  )
+  session.mount("https://", adapter)
+  session.mount("http://", adapter)
+  session.headers["Connection"] = "keep-alive"
+  return session, adapter
+
+
+class AsyncClientPool:
+  """Um `httpx.AsyncClient` por event loop.
+
+  Com `python bot.py` a API roda num loop (thread do uvicorn) e o bot em
+  outro; conexões do httpx não podem ser compartilhadas entre loops.
+  """
+
+  def __init__(self):
+    self._clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+    # Contadores somados entre os loops (mesmo formato de PooledAdapter.stats)
+    self._requests = 0
+    self._connections = 0
+    self._lock = threading.Lock()
+
+  async def _trace(self, event: str, info: dict):
+    # Trace do httpcore: cada conexão TCP nova passa por aqui uma vez
+    if event == "connection.connect_tcp.complete":
+      with self._lock:
+        self._connections += 1
+
+  async def _on_request(self, request: httpx.Request):
+    with self._lock:
+      self._requests += 1
+    request.extensions["trace"] = self._trace
+
+  def stats(self) -> Dict[str, int]:
+    with self._lock:
+      return {
+          "requests": self._requests,
+          "connections_opened": self._connections,
+          "connections_reused": max(self._requests - self._connections, 0),
+      }
+
+  def get(self) -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = self._clients.get(loop)
+    if client is None or client.is_closed:
+      client = httpx.AsyncClient(
+          timeout=httpx.Timeout(settings.gateway_read_timeout, connect=settings.gateway_connect_timeout),
+          limits=httpx.Limits(
+              max_connections=settings.gateway_pool_maxsize,
+              max_keepalive_connections=settings.gateway_pool_maxsize,
+          ),
+          headers={"Connection": "keep-alive"},
+          event_hooks={"request": [self._on_request]},
+      )
+      self._clients[loop] = client
+    return client
@@ -0,0 +1,247 @@
+"""Interface comum dos gateways Pix e roteamento entre eles.
+
+Cada provedor (PushinPay, SyncPay) é embrulhado num `Gateway` que devolve
+respostas normalizadas (`PixCharge` e status no vocabulário do `Payment`).
+O `GatewayRouter` mede latência e taxa de erro recentes de cada um, manda
+checkouts novos para o mais saudável (com failover quando ele falha) e
+consulta cada pagamento no gateway que o emitiu (`Payment.gateway`).
+"""
+from __future__ import annotations
+
+import logging
+import threading
+from abc import ABC, abstractmethod
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from config import settings
+from pushinpay import async_pushinpay_client
+from qr import qr_renderer
+from resilience import GatewayGuard, GatewayUnavailableError, is_gateway_failure, pushinpay_guard, syncpay_guard
+from storage import Payment
+from syncpay import async_syncpay_client
+
+log = logging.getLogger(__name__)
+
+# Acima dessa taxa de erro recente o gateway perde a vez para um ainda sem medições
+HEALTHY_ERROR_RATE = 0.5
+
+
+# Status dos gateways -> status do Payment
+_STATUS_MAP = {
+    "paid": "paid",
+    "approved": "paid",
+    "completed": "paid",
+    "confirmed": "paid",
+    "success": "paid",
+    "canceled": "canceled",
+    "cancelled": "canceled",
+    "failed": "canceled",
+    "refunded": "refunded",
+    "expired": "expired",
+}
+
+
+def normalize_status(raw: Optional[str]) -> str:
+  """Traduz o status do gateway; qualquer coisa desconhecida continua `pending`."""
+  return _STATUS_MAP.get((raw or "").strip().lower(), "pending")
+
+
+@dataclass(slots=True)
+class PixCharge:
+  """Pix criado num gateway, já normalizado."""
+  gateway: str
+  transaction_id: str
+  pix_code: str
+  qr_base64: Optional[str] = None
+
+
+async def render_qr(pix_code: str, fmt: Optional[str] = None) -> str:
+  """Gera o QR Code (PNG base64) fora do event loop, com cache (ver qr.py)"""
+  return await qr_renderer.arender(pix_code, fmt)
+
+
+class Gateway(ABC):
+  """Contrato de um provedor Pix para o roteador.
+
+  Um gateway incompleto falha ao ser instanciado, não no meio de um checkout.
+  """
+
+  name: str = ""
+  guard: GatewayGuard
+
+  @abstractmethod
+  def configured(self) -> bool:
+    """Credenciais presentes para usar este gateway."""
+
+  @abstractmethod
+  async def create_charge(self, amount: float, description: str, reference_id: str) -> PixCharge:
+    """Cria o Pix e devolve a resposta normalizada."""
+
+  @abstractmethod
+  async def fetch_status(self, transaction_id: str) -> str:
+    """Status da transação no vocabulário do `Payment` (ver `normalize_status`)."""
+
+
+class PushinPayGateway(Gateway):
+  name = "pushinpay"
+  guard = pushinpay_guard
+
+  def configured(self) -> bool:
+    return bool(settings.pushinpay_api_key)
+
+  async def create_charge(self, amount: float, description: str, reference_id: str) -> PixCharge:
+    # PushinPay retorna: { "id", "qr_code", "status", "value", "qr_code_base64", ... }
+    data = await async_pushinpay_client.create_pix(amount, description, reference_id)
+    return PixCharge(
+        gateway=self.name,
+        transaction_id=str(data.get("id") or reference_id),
+        pix_code=data.get("qr_code") or "",
+        qr_base64=data.get("qr_code_base64") or data.get("qrCodeBase64"),
+    )
+
+  async def fetch_status(self, transaction_id: str) -> str:
+    # PushinPay retorna: "created" | "paid" | "canceled"
+    data = await async_pushinpay_client.get_transaction(transaction_id)
+    return normalize_status(data.get("status"))
+
+
+class SyncPayGateway(Gateway):
+  name = "syncpay"
+  guard = syncpay_guard
+
+  def configured(self) -> bool:
+    return bool(settings.syncpay_client_id and settings.syncpay_client_secret)
+
+  @staticmethod
+  def _body(data: dict) -> dict:
+    # Algumas respostas da SyncPay vêm embrulhadas em {"data": {...}}
+    inner = data.get("data")
+    return inner if isinstance(inner, dict) else data
+
+  async def create_charge(self, amount: float, description: str, reference_id: str) -> PixCharge:
+    data = self._body(await async_syncpay_client.create_pix(amount, description, reference_id))
+    return PixCharge(
+        gateway=self.name,
+        transaction_id=str(data.get("transaction_id") or data.get("id") or data.get("identifier") or reference_id),
+        pix_code=data.get("pix_code") or data.get("qr_code") or data.get("copy_paste") or data.get("emv") or "",
+        qr_base64=data.get("qr_code_base64") or data.get("qr_base64"),
+    )
+
+  async def fetch_status(self, transaction_id: str) -> str:
+    data = self._body(await async_syncpay_client.get_transaction(transaction_id))
+    return normalize_status(data.get("status"))
+
+
+class GatewayStats:
+  """Janela das últimas chamadas de um gateway: latência e taxa de erro."""
+
+  def __init__(self, window: int):
+    self._samples: deque = deque(maxlen=max(window, 1))
+    self._lock = threading.Lock()
+
+  def record(self, latency: float, ok: bool):
+    with self._lock:
+      self._samples.append((latency, ok))
+
+  def snapshot(self) -> dict:
+    with self._lock:
+      samples = list(self._samples)
+    if not samples:
+      return {"samples": 0, "latency_ms": None, "error_rate": 0.0}
+    latency = sum(sample[0] for sample in samples) / len(samples)
+    errors = sum(1 for sample in samples if not sample[1])
+    return {
+        "samples": len(samples),
+        "latency_ms": round(latency * 1000, 1),
+        "error_rate": round(errors / len(samples), 3),
+    }
+
+  def score(self) -> float:
+    """Menor é melhor: latência média inflada pela taxa de erro."""
+    stats = self.snapshot()
+    if not stats["samples"]:
+      # Sem medições ainda: ranked() o coloca depois dos saudáveis
+      return 0.0
+    return (stats["latency_ms"] / 1000) * (1 + 10 * stats["error_rate"]) + 5 * stats["error_rate"]
+
+
+class GatewayRouter:
+  """Escolhe o gateway de cada checkout e consulta pagamentos no gateway certo."""
+
+  def __init__(self, gateways: List[Gateway], order: List[str], window: int = settings.gateway_stats_window):
+    self.gateways: Dict[str, Gateway] = {gateway.name: gateway for gateway in gateways}
+    # Gateways fora de GATEWAY_ORDER ficam desativados para checkouts novos
+    self.order = [name for name in order if name in self.gateways]
+    self.stats: Dict[str, GatewayStats] = {name: GatewayStats(window) for name in self.gateways}
+
+  def ranked(self) -> List[Gateway]:
+    """Gateways configurados que aceitam chamada agora, do mais saudável ao menos.
+
+    Circuito aberto só exclui o gateway até a hora do teste (`reset_timeout`);
+    depois ele volta à lista para a chamada de teste poder acontecer.
+    Gateways sem medições vêm depois dos saudáveis e antes dos que andam falhando.
+    """
+    candidates = []
+    for position, name in enumerate(self.order):
+      gateway = self.gateways[name]
+      if not gateway.configured() or not gateway.guard.breaker.available():
+        continue
+      stats = self.stats[name].snapshot()
+      if not stats["samples"]:
+        tier = 1
+      else:
+        tier = 0 if stats["error_rate"] < HEALTHY_ERROR_RATE else 2
+      candidates.append((tier, self.stats[name].score(), position, gateway))
+    candidates.sort(key=lambda item: item[:3])
+    return [gateway for _, _, _, gateway in candidates]
+
+  async def _measure(self, name: str, call):
+    started = time.monotonic()
+    try:
+      result = await call
+    except Exception as exc:
+      # Circuito aberto/limite local não diz nada novo sobre a latência do gateway
+      if not isinstance(exc, GatewayUnavailableError):
+        self.stats[name].record(time.monotonic() - started, not is_gateway_failure(exc))
+      raise
+    self.stats[name].record(time.monotonic() - started, True)
+    return result
+
+  async def create_charge(self, amount: float, description: str, reference_id: str) -> PixCharge:
+    """Cria o Pix no gateway mais saudável, passando para o próximo se ele falhar.
+
+    Só troca de gateway em falhas do próprio gateway (rede, 5xx, 429,
+    circuito aberto); erros de configuração ou 4xx sobem na hora.
+    """
+    candidates = self.ranked()
+    if not candidates:
+      raise GatewayUnavailableError("Nenhum gateway de pagamento disponível", settings.circuit_reset_timeout)
+    last_exc: Optional[BaseException] = None
+    for gateway in candidates:
+      try:
+        return await self._measure(gateway.name, gateway.create_charge(amount, description, reference_id))
+      except Exception as exc:
+        if not (isinstance(exc, GatewayUnavailableError) or is_gateway_failure(exc)):
+          raise
+        log.warning("Gateway %s falhou ao criar Pix (%s); tentando o próximo", gateway.name, exc)
+        last_exc = exc
+    raise last_exc
+
+  async def fetch_status(self, payment: Payment) -> str:
+    """Consulta o status normalizado no gateway que emitiu o pagamento."""
+    gateway = self.gateways.get(payment.gateway or "pushinpay")
+    if gateway is None:
+      raise ValueError(f"Gateway desconhecido: {payment.gateway}")
+    return await self._measure(gateway.name, gateway.fetch_status(payment.syncpay_id or payment.payment_id))
+
+  def snapshot(self) -> dict:
+    return {
+        "order": [gateway.name for gateway in self.ranked()],
+        "stats": {name: stats.snapshot() for name, stats in self.stats.items()},
+    }
+
+
+router = GatewayRouter([PushinPayGateway(), SyncPayGateway()], settings.gateway_order)
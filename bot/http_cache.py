@@ -0,0 +1,129 @@
+"""Cache HTTP das respostas da API (ETag, 304 e corpo pré-comprimido).
+
+O catálogo (`GET /products`) é serializado e comprimido uma vez e só é
+refeito quando muda: na hora, se a mudança passou por este processo
+(`astore.catalog_version`), ou em até `CATALOG_CACHE_TTL` segundos se foi
+feita por outro processo. Enquanto isso, as requisições (inclusive o 304
+de `If-None-Match`) não tocam no armazenamento.
+"""
+from __future__ import annotations
+
+import asyncio
+import gzip
+import hashlib
+import json
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional
+
+from config import settings
+from storage import astore
+
+# Abaixo disso o gzip não compensa o cabeçalho extra
+GZIP_MIN_BYTES = 512
+
+
+def strong_etag(body: bytes) -> str:
+  return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+  """Comparação fraca do If-None-Match (RFC 9110): ignora `W/` e aceita `*`."""
+  if not if_none_match:
+    return False
+  wanted = etag.removeprefix("W/")
+  for candidate in if_none_match.split(","):
+    candidate = candidate.strip()
+    if candidate == "*" or candidate.removeprefix("W/") == wanted:
+      return True
+  return False
+
+
+def http_date(iso_utc: str) -> Optional[str]:
+  """`updated_at` (ISO em UTC, sem fuso) no formato do Last-Modified"""
+  try:
+    moment = datetime.fromisoformat(iso_utc)
+  except (TypeError, ValueError):
+    return None
+  if moment.tzinfo is None:
+    moment = moment.replace(tzinfo=timezone.utc)
+  return format_datetime(moment.replace(microsecond=0), usegmt=True)
+
+
+def not_modified_since(if_modified_since: Optional[str], last_modified: Optional[str]) -> bool:
+  if not if_modified_since or not last_modified:
+    return False
+  try:
+    return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+  except (TypeError, ValueError):
+    return False
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+  for coding in (accept_encoding or "").split(","):
+    name, _, params = coding.strip().partition(";")
+    if name.strip().lower() in ("gzip", "*"):
+      return params.replace(" ", "") not in ("q=0", "q=0.0")
+  return False
+
+
+@dataclass(frozen=True)
+class CachedBody:
+  etag: str
+  body: bytes
+  gzip_body: Optional[bytes]
+
+  @property
+  def gzip_etag(self) -> str:
+    # ETag forte é por representação: a versão gzip ganha um sufixo próprio
+    return self.etag[:-1] + '-gzip"'
+
+  def matches(self, if_none_match: Optional[str]) -> bool:
+    return etag_matches(if_none_match, self.etag) or etag_matches(if_none_match, self.gzip_etag)
+
+
+def build_body(payload) -> CachedBody:
+  body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+  compressed = gzip.compress(body, compresslevel=9, mtime=0) if len(body) >= GZIP_MIN_BYTES else None
+  return CachedBody(strong_etag(body), body, compressed)
+
+
+class CatalogCache:
+  def __init__(self, ttl: float = settings.catalog_cache_ttl):
+    self.ttl = ttl
+    self._cached: Optional[CachedBody] = None
+    self._version = -1
+    self._built_at = 0.0
+    self._lock = asyncio.Lock()
+
+  def fresh(self) -> Optional[CachedBody]:
+    """O corpo atual, se ainda vale (sem acessar o armazenamento)."""
+    if self._cached is None or self._version != astore.catalog_version:
+      return None
+    if time.monotonic() - self._built_at >= self.ttl:
+      return None
+    return self._cached
+
+  async def get(self) -> CachedBody:
+    cached = self.fresh()
+    if cached is not None:
+      return cached
+    # Um rebuild por vez; quem chegou junto reaproveita o resultado
+    async with self._lock:
+      cached = self.fresh()
+      if cached is not None:
+        return cached
+      version = astore.catalog_version
+      products = await astore.list_products()
+      rebuilt = build_body([asdict(product) for product in products])
+      # Mesmo conteúdo (ex.: TTL vencido sem mudança): mantém o objeto e a ETag
+      if self._cached is None or self._cached.etag != rebuilt.etag:
+        self._cached = rebuilt
+      self._version = version
+      self._built_at = time.monotonic()
+      return self._cached
+
+
+catalog_cache = CatalogCache()
@@ -0,0 +1,91 @@
+"""Deduplicação de checkouts: single-flight + cache curto por chave.
+
+Cliques repetidos em "Gerar Código Pix" chegam com a mesma chave (o
+`Idempotency-Key`, ou `customer_ref` + produto). A primeira requisição
+cria o Pix; as que chegam enquanto ela está em andamento esperam o mesmo
+resultado, e as que chegam depois, dentro de `IDEMPOTENCY_WINDOW`
+segundos, recebem a resposta guardada. Erros não ficam no cache.
+
+O estado fica em memória, por processo, e funciona entre event loops
+(bot e API), porque a espera usa `concurrent.futures.Future`.
+"""
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from config import settings
+
+
+class SingleFlight:
+  def __init__(self, window: float = settings.idempotency_window, max_entries: int = 10000):
+    self.window = window
+    self.max_entries = max_entries
+    self._lock = threading.Lock()
+    self._inflight: Dict[str, Future] = {}
+    self._done: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+    self.hits = 0
+
+  def _evict(self, now: float):
+    while self._done:
+      key, (expires_at, _) = next(iter(self._done.items()))
+      if expires_at > now and len(self._done) <= self.max_entries:
+        break
+      del self._done[key]
+
+  async def run(self, key: Optional[str], factory: Callable[[], Awaitable[Any]]) -> Any:
+    """Executa `factory()` uma vez por chave; sem chave, executa sempre."""
+    if not key or self.window <= 0:
+      return await factory()
+    while True:
+      with self._lock:
+        now = time.monotonic()
+        self._evict(now)
+        cached = self._done.get(key)
+        if cached is not None:
+          self.hits += 1
+          return cached[1]
+        future = self._inflight.get(key)
+        leader = future is None
+        if leader:
+          future = Future()
+          self._inflight[key] = future
+      if leader:
+        break
+      try:
+        # shield: se este cliente desistir, a requisição líder segue normalmente
+        result = await asyncio.shield(asyncio.wrap_future(future))
+      except asyncio.CancelledError:
+        # A líder foi cancelada (cliente dela desconectou): tenta de novo
+        if future.cancelled():
+          continue
+        raise
+      self.hits += 1
+      return result
+
+    try:
+      result = await factory()
+    except BaseException as exc:
+      with self._lock:
+        self._inflight.pop(key, None)
+      if isinstance(exc, Exception):
+        future.set_exception(exc)
+      else:
+        future.cancel()
+      raise
+    with self._lock:
+      self._inflight.pop(key, None)
+      self._done[key] = (time.monotonic() + self.window, result)
+    future.set_result(result)
+    return result
+
+  def snapshot(self) -> dict:
+    with self._lock:
+      return {"cached": len(self._done), "in_flight": len(self._inflight), "hits": self.hits}
+
+
+checkouts = SingleFlight()
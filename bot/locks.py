@@ -0,0 +1,83 @@
+"""Lock exclusivo entre processos baseado em arquivo.
+
+Usa `fcntl.flock` no Linux/macOS e `msvcrt.locking` no Windows. O lock é
+consultivo: só protege quem também usa `FileLock` no mesmo arquivo.
+"""
+from __future__ import annotations
+
+import os
+import threading
+import time
+from pathlib import Path
+from typing import IO, Optional
+
+if os.name == "nt":
+  import msvcrt
+else:
+  import fcntl
+
+
+class FileLock:
+  """Lock exclusivo entre processos (e entre threads do mesmo processo)."""
+
+  def __init__(self, path: Path):
+    self.path = path
+    self._thread_lock = threading.Lock()
+    self._fh: Optional[IO[bytes]] = None
+
+  def _lock_file(self, fh: IO[bytes], blocking: bool) -> bool:
+    if os.name == "nt":
+      fh.seek(0)
+      while True:
+        try:
+          msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)
+          return True
+        except OSError:
+          if not blocking:
+            return False
+          time.sleep(0.01)
+    try:
+      fcntl.flock(fh.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+      return True
+    except BlockingIOError:
+      return False
+
+  def acquire(self, blocking: bool = True) -> bool:
+    if not self._thread_lock.acquire(blocking):
+      return False
+    try:
+      fh = open(self.path, "a+b")
+    except OSError:
+      self._thread_lock.release()
+      raise
+    try:
+      locked = self._lock_file(fh, blocking)
+    except BaseException:
+      fh.close()
+      self._thread_lock.release()
+      raise
+    if not locked:
+      fh.close()
+      self._thread_lock.release()
+      return False
+    self._fh = fh
+    return True
+
+  def release(self):
+    fh, self._fh = self._fh, None
+    try:
+      if os.name == "nt":
+        fh.seek(0)
+        msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+      else:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+    finally:
+      fh.close()
+      self._thread_lock.release()
+
+  def __enter__(self) -> "FileLock":
+    self.acquire()
+    return self
+
+  def __exit__(self, *exc):
+    self.release()
@@ -148,8 +148,25 @@ def generate_product_page(product: Product, output_dir: Path) -> Path:
         product: PRODUCT_DATA,
         paymentId: null,
         pollTimer: null,
+        events: null,
       }};
 
+      // Identificador estável do visitante: cliques repetidos reaproveitam o mesmo Pix
+      function customerRef() {{
+        const key = "conteudovip_customer_ref";
+        try {{
+          let ref = localStorage.getItem(key);
+          if (!ref) {{
+            ref = crypto.randomUUID ? crypto.randomUUID() : `${{Date.now()}}-${{Math.random()}}`;
+            localStorage.setItem(key, ref);
+          }}
+          return ref;
+        }} catch (e) {{
+          state.customerRef = state.customerRef || `${{Date.now()}}-${{Math.random()}}`;
+          return state.customerRef;
+        }}
+      }}
+
       const pixLoading = document.getElementById("pix-loading");
       const pixGenerate = document.getElementById("pix-generate");
       const pixContent = document.getElementById("pix-content");
@@ -212,9 +229,10 @@ def generate_product_page(product: Product, output_dir: Path) -> Path:
         }}
 
         try {{
+          const ref = customerRef();
           const requestBody = {{
             product_id: PRODUCT_ID,
-            customer_ref: crypto.randomUUID ? crypto.randomUUID() : `${{Date.now()}}-${{Math.random()}}`,
+            customer_ref: ref,
           }};
           
           console.log("📤 Enviando requisição para API:");
@@ -223,7 +241,8 @@ def generate_product_page(product: Product, output_dir: Path) -> Path:
           
           const response = await fetch(`${{API_BASE_URL}}/checkout`, {{
             method: "POST",
-            headers: {{ "Content-Type": "application/json" }},
+            // Mesma chave em cliques repetidos: a API devolve o mesmo Pix
+            headers: {{ "Content-Type": "application/json", "Idempotency-Key": ref }},
             body: JSON.stringify(requestBody),
           }});
 
@@ -429,33 +448,65 @@ def generate_product_page(product: Product, output_dir: Path) -> Path:
         }}
       }}
 
+      function stopWatching() {{
+        if (state.pollTimer) {{
+          clearInterval(state.pollTimer);
+          state.pollTimer = null;
+        }}
+        if (state.events) {{
+          state.events.close();
+          state.events = null;
+        }}
+      }}
+
+      function handlePaymentStatus(data) {{
+        if (data.status === "paid") {{
+          if (pixStatus) pixStatus.textContent = "✅ Pagamento confirmado! Acesso liberado!";
+          if (pixLinkWaiting) pixLinkWaiting.style.display = "none";
+          if (data.secret_link && secretLink) {{
+            secretLink.href = data.secret_link;
+            secretLink.textContent = "Abrir conteúdo premium";
+            if (pixSecret) {{
+              pixSecret.removeAttribute("hidden");
+              pixSecret.style.display = "block";
+            }}
+          }}
+          stopWatching();
+        }} else if (["expired", "canceled", "cancelled", "refunded", "failed"].includes(data.status)) {{
+          // Qualquer status final encerra o acompanhamento (o servidor também fecha o stream)
+          if (pixStatus) pixStatus.textContent = ["expired", "canceled"].includes(data.status)
+              ? "Este Pix expirou. Gere um novo para continuar."
+              : "Este Pix foi encerrado. Gere um novo para continuar.";
+          stopWatching();
+        }}
+      }}
+
       function pollPayment() {{
         if (!state.paymentId) return;
-        fetch(`${{API_BASE_URL}}/payments/${{state.paymentId}}`)
+        fetch(`${{API_BASE_URL}}/payments/${{state.paymentId}}?view=status`)
           .then(res => res.json())
-          .then(data => {{
-            if (data.status === "paid") {{
-              if (pixStatus) pixStatus.textContent = "✅ Pagamento confirmado! Acesso liberado!";
-              if (pixLinkWaiting) pixLinkWaiting.style.display = "none";
-              if (data.secret_link && secretLink) {{
-                secretLink.href = data.secret_link;
-                secretLink.textContent = "Abrir conteúdo premium";
-                if (pixSecret) {{
-                  pixSecret.removeAttribute("hidden");
-                  pixSecret.style.display = "block";
-                }}
-              }}
-              if (state.pollTimer) {{
-                clearInterval(state.pollTimer);
-                state.pollTimer = null;
-              }}
-            }}
-          }})
+          .then(handlePaymentStatus)
           .catch(() => {{}});
       }}
 
       function startPolling() {{
-        if (state.pollTimer) clearInterval(state.pollTimer);
+        stopWatching();
+        // Stream SSE: o servidor avisa na hora em que o pagamento muda
+        if (window.EventSource) {{
+          const events = new EventSource(`${{API_BASE_URL}}/payments/${{state.paymentId}}/events`);
+          state.events = events;
+          events.addEventListener("status", (event) => handlePaymentStatus(JSON.parse(event.data)));
+          // Fim explícito: fecha em vez de deixar o navegador reconectar
+          events.addEventListener("end", stopWatching);
+          events.onerror = () => {{
+            // Erros de rede o navegador reconecta sozinho; fechado de vez, volta ao polling
+            if (events.readyState === EventSource.CLOSED && state.events === events) {{
+              state.events = null;
+              state.pollTimer = setInterval(pollPayment, 4000);
+            }}
+          }};
+          return;
+        }}
         state.pollTimer = setInterval(pollPayment, 4000);
       }}
 
@@ -0,0 +1,80 @@
+"""Avisos de mudança de status de pagamento para conexões abertas (SSE).
+
+Quem acompanha um pagamento (`/payments/{id}/events`) registra um
+`Watcher` e dorme até ser acordado. Os avisos vêm de toda gravação de
+status feita por este processo (`astore.on_status_change`: webhooks e
+conciliação) e dos pagamentos confirmados que o `reconcile.engine` vê
+chegar de outros processos. Cada watcher guarda o event loop em que foi
+criado, então o aviso pode vir de qualquer thread.
+"""
+from __future__ import annotations
+
+import asyncio
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Set
+
+from storage import astore
+
+
+class Watcher:
+  def __init__(self, loop: asyncio.AbstractEventLoop):
+    self._loop = loop
+    self._event = asyncio.Event()
+    self.status: Optional[str] = None
+
+  def _set(self, status: str):
+    self.status = status
+    self._event.set()
+
+  def notify(self, status: str):
+    try:
+      self._loop.call_soon_threadsafe(self._set, status)
+    except RuntimeError:
+      # Loop já encerrado: a conexão morreu junto
+      pass
+
+  async def wait(self, timeout: float) -> Optional[str]:
+    """Status avisado desde a última espera, ou None se o tempo acabar."""
+    try:
+      await asyncio.wait_for(self._event.wait(), timeout)
+    except asyncio.TimeoutError:
+      return None
+    self._event.clear()
+    return self.status
+
+
+class PaymentWatchers:
+  def __init__(self):
+    self._watchers: Dict[str, Set[Watcher]] = {}
+    self._lock = threading.Lock()
+
+  @contextmanager
+  def watch(self, payment_id: str) -> Iterator[Watcher]:
+    """Registra antes de ler o status atual, para não perder um aviso no meio."""
+    watcher = Watcher(asyncio.get_running_loop())
+    with self._lock:
+      self._watchers.setdefault(payment_id, set()).add(watcher)
+    try:
+      yield watcher
+    finally:
+      with self._lock:
+        watchers = self._watchers.get(payment_id)
+        if watchers is not None:
+          watchers.discard(watcher)
+          if not watchers:
+            del self._watchers[payment_id]
+
+  def notify(self, payment_id: str, status: str):
+    with self._lock:
+      watchers = list(self._watchers.get(payment_id, ()))
+    for watcher in watchers:
+      watcher.notify(status)
+
+  def count(self) -> int:
+    with self._lock:
+      return sum(len(watchers) for watchers in self._watchers.values())
+
+
+payment_watchers = PaymentWatchers()
+astore.on_status_change(payment_watchers.notify)
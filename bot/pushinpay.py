@@ -1,33 +1,70 @@
 from __future__ import annotations
 
-import base64
 from typing import Optional
 import logging
 
+from urllib.parse import urlencode
+
+import httpx
 import requests
 
 from config import settings
+from gateway_http import AsyncClientPool, create_session, gateway_timeout
+from qr import qr_renderer
+from resilience import pushinpay_guard
 
 log = logging.getLogger(__name__)
 
 
+def webhook_url() -> Optional[str]:
+  """URL do nosso /webhooks/pushinpay, com o segredo compartilhado em `?token=`
+
+  Sem PUSHINPAY_WEBHOOK_SECRET o webhook não é registrado: a API recusa
+  chamadas sem segredo e a confirmação fica só com o polling.
+  """
+  url = settings.pushinpay_webhook_url
+  if not url or not settings.pushinpay_webhook_secret:
+    return None
+  return url + ("&" if "?" in url else "?") + urlencode({"token": settings.pushinpay_webhook_secret})
+
+
+def cash_in_payload(amount_cents: int) -> dict:
+  payload = {
+    "value": amount_cents,  # Valor em centavos (mínimo 50)
+  }
+  # Com webhook a confirmação chega na hora; o polling vira só plano B
+  url = webhook_url()
+  if url:
+    payload["webhook_url"] = url
+  return payload
+
+
+def _bearer_headers(api_key: Optional[str]) -> dict:
+  if not api_key:
+    error_msg = "PUSHINPAY_API_KEY não configurado!"
+    log.error(error_msg)
+    raise ValueError(error_msg)
+
+  return {
+    "Authorization": f"Bearer {api_key}",
+    "Accept": "application/json",
+    "Content-Type": "application/json",
+  }
+
+
 class PushinPayClient:
   def __init__(self):
     self._api_key: Optional[str] = settings.pushinpay_api_key
     self._base_url: str = settings.pushinpay_base_url
+    self._session, self._adapter = create_session()
+
+  def connection_stats(self) -> dict:
+    """Contadores do pool de conexões (para monitoramento)"""
+    return self._adapter.stats()
 
   def _auth_headers(self) -> dict:
     """Retorna headers de autenticação"""
-    if not self._api_key:
-      error_msg = "PUSHINPAY_API_KEY não configurado!"
-      log.error(error_msg)
-      raise ValueError(error_msg)
-    
-    return {
-      "Authorization": f"Bearer {self._api_key}",
-      "Accept": "application/json",
-      "Content-Type": "application/json",
-    }
+    return _bearer_headers(self._api_key)
 
   def create_pix(self, amount: float, description: str, reference_id: str) -> dict:
     """
@@ -41,6 +78,9 @@ class PushinPayClient:
     Returns:
       dict com os dados do PIX criado
     """
+    return pushinpay_guard.call(self._create_pix, amount, description, reference_id)
+
+  def _create_pix(self, amount: float, description: str, reference_id: str) -> dict:
     # PushinPay trabalha com valores em centavos (mínimo 50 centavos)
     amount_cents = int(amount * 100)
     
@@ -50,27 +90,25 @@ class PushinPayClient:
     # Baseado na documentação oficial: https://app.theneo.io/pushinpay/pix/pix/criar-pix
     # Endpoint correto: /pix/cashIn
     # Body: { "value": number, "webhook_url": string (opcional), "split_rules": array (opcional) }
-    payload = {
-      "value": amount_cents,  # Valor em centavos (mínimo 50)
-    }
+    payload = cash_in_payload(amount_cents)
     
     # URL base: https://api.pushinpay.com.br/api
     # Endpoint: /pix/cashIn
     url = f"{self._base_url}/pix/cashIn"
     
     log.info("Criando PIX PushinPay - URL: %s", url)
-    log.info("Criando PIX PushinPay - Payload: %s", payload)
+    log.info("Criando PIX PushinPay - Valor: %s centavos", amount_cents)
     log.info("Criando PIX PushinPay - API Key configurada: %s", "SIM" if self._api_key else "NÃO")
     
     try:
       headers = self._auth_headers()
       log.info("Criando PIX PushinPay - Headers (sem token): %s", {k: v[:20] + "..." if len(v) > 20 else v for k, v in headers.items()})
       
-      response = requests.post(
+      response = self._session.post(
         url,
         json=payload,
         headers=headers,
-        timeout=20,
+        timeout=gateway_timeout(),
       )
       
       log.info("Criando PIX PushinPay - Status: %s", response.status_code)
@@ -121,15 +159,18 @@ class PushinPayClient:
     Returns:
       dict com os dados da transação
     """
+    return pushinpay_guard.call(self._get_transaction, transaction_id, idempotent=True)
+
+  def _get_transaction(self, transaction_id: str) -> dict:
     # Baseado na documentação: GET /transactions/{id}
     # https://app.theneo.io/pushinpay/pix/pix/consultar-pix
     url = f"{self._base_url}/transactions/{transaction_id}"
     
     try:
-      response = requests.get(
+      response = self._session.get(
         url,
         headers=self._auth_headers(),
-        timeout=20,
+        timeout=gateway_timeout(),
       )
       response.raise_for_status()
       return response.json()
@@ -148,17 +189,87 @@ class PushinPayClient:
     Returns:
       String base64 da imagem do QR Code
     """
-    import qrcode
-    from io import BytesIO
+    return qr_renderer.render(pix_code)
+
+
+class AsyncPushinPayClient:
+  """Versão assíncrona (httpx) do PushinPayClient, com as mesmas respostas.
+
+  Erros HTTP chegam como `httpx.HTTPStatusError` (mesmo `.response` com
+  `status_code`, `json()` e `text`).
+  """
+
+  def __init__(self):
+    self._api_key: Optional[str] = settings.pushinpay_api_key
+    self._base_url: str = settings.pushinpay_base_url
+    self._clients = AsyncClientPool()
+
+  def connection_stats(self) -> dict:
+    """Contadores do pool de conexões do httpx (para monitoramento)"""
+    return self._clients.stats()
+
+  def _auth_headers(self) -> dict:
+    return _bearer_headers(self._api_key)
+
+  async def create_pix(self, amount: float, description: str, reference_id: str) -> dict:
+    """Cria um PIX (ver PushinPayClient.create_pix)"""
+    return await pushinpay_guard.acall(self._create_pix, amount, description, reference_id)
+
+  async def _create_pix(self, amount: float, description: str, reference_id: str) -> dict:
+    amount_cents = int(amount * 100)
+    if amount_cents < 50:
+      raise ValueError("Valor mínimo é R$ 0,50 (50 centavos)")
+
+    payload = cash_in_payload(amount_cents)
+    url = f"{self._base_url}/pix/cashIn"
+    log.info("Criando PIX PushinPay (async) - URL: %s - Valor: %s", url, amount_cents)
+
+    try:
+      response = await self._clients.get().post(url, json=payload, headers=self._auth_headers())
+      log.info("Criando PIX PushinPay (async) - Status: %s", response.status_code)
 
-    qr = qrcode.QRCode(version=4, box_size=6, border=2)
-    qr.add_data(pix_code)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    buffer = BytesIO()
-    img.save(buffer, format="PNG")
-    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+      if response.status_code == 404:
+        error_msg = (
+          f"Endpoint não encontrado (404): {url}\n"
+          f"Verifique se a URL está correta no arquivo .env\n"
+          f"URL configurada: {self._base_url}"
+        )
+        log.error(error_msg)
+        raise httpx.HTTPStatusError(error_msg, request=response.request, response=response)
+
+      response.raise_for_status()
+      data = response.json()
+      if not (data.get("qr_code_base64") or data.get("qrCodeBase64")):
+        log.warning("QR Code base64 NÃO recebido na resposta da API PushinPay")
+      return data
+
+    except httpx.HTTPStatusError as e:
+      log.error("Erro HTTP ao criar PIX PushinPay: %s - %s", e.response.status_code, e.response.text[:500])
+      raise
+    except Exception:
+      log.exception("Erro inesperado ao criar PIX PushinPay")
+      raise
+
+  async def get_transaction(self, transaction_id: str) -> dict:
+    """Consulta uma transação PIX (ver PushinPayClient.get_transaction)"""
+    return await pushinpay_guard.acall(self._get_transaction, transaction_id, idempotent=True)
+
+  async def _get_transaction(self, transaction_id: str) -> dict:
+    url = f"{self._base_url}/transactions/{transaction_id}"
+    try:
+      response = await self._clients.get().get(url, headers=self._auth_headers())
+      response.raise_for_status()
+      return response.json()
+    except Exception:
+      log.exception("Erro ao consultar transação PushinPay")
+      raise
+
+  @staticmethod
+  async def generate_qr_base64(pix_code: str) -> str:
+    """Gera o QR Code fora do event loop"""
+    return await qr_renderer.arender(pix_code)
 
 
 pushinpay_client = PushinPayClient()
+async_pushinpay_client = AsyncPushinPayClient()
 
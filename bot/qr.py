@@ -0,0 +1,225 @@
+"""Renderização de QR Codes Pix, compartilhada pelos gateways.
+
+- Cache LRU por `pix_code`: o mesmo código nunca é renderizado duas vezes
+  enquanto estiver no cache.
+- A versão assíncrona roda em processos renderizadores (`QR_WORKERS`), então
+  o trabalho do PIL não disputa o GIL com as requisições. Cada um é este
+  arquivo rodando como script (`python qr.py`): importa só `config` e
+  `qrcode`, nunca o `bot.py`/`api.py` que o iniciou (o multiprocessing
+  reimportaria o script principal, com armazenamento e tudo).
+- `QR_FORMAT`: `png` (padrão, igual ao de sempre) ou `png-compact` (PNG de
+  1 bit com módulos de 2 px, bem menor; o site amplia com
+  `image-rendering: pixelated`). `render_svg` gera um SVG vetorial enxuto,
+  servido em `/payments/{id}/qr.svg`.
+"""
+from __future__ import annotations
+
+import asyncio
+import base64
+import json
+import logging
+import queue
+import subprocess
+import sys
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from typing import Optional, Tuple
+
+from config import settings
+
+log = logging.getLogger(__name__)
+
+# Formato -> (box_size, border) do qrcode
+PNG_FORMATS = {
+    "png": (6, 2),
+    "png-compact": (2, 2),
+}
+
+
+def _matrix(pix_code: str, box_size: int, border: int):
+  import qrcode
+
+  qr = qrcode.QRCode(version=4, box_size=box_size, border=border)
+  qr.add_data(pix_code)
+  qr.make(fit=True)
+  return qr
+
+
+def render_png(pix_code: str, fmt: str = "png") -> str:
+  """Renderiza o PNG em base64 (roda tanto no processo atual quanto nos renderizadores)"""
+  box_size, border = PNG_FORMATS[fmt]
+  qr = _matrix(pix_code, box_size, border)
+  img = qr.make_image(fill_color="black", back_color="white")
+  buffer = BytesIO()
+  img.save(buffer, format="PNG", optimize=fmt != "png")
+  return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+def render_svg(pix_code: str, border: int = 2) -> str:
+  """SVG com um único path de segmentos horizontais (escala sem perder nitidez)"""
+  modules = _matrix(pix_code, 1, border).get_matrix()
+  size = len(modules)
+  runs = []
+  for y, row in enumerate(modules):
+    x = 0
+    while x < size:
+      if row[x]:
+        start = x
+        while x < size and row[x]:
+          x += 1
+        runs.append(f"M{start} {y}h{x - start}v1h-{x - start}z")
+      else:
+        x += 1
+  return (
+      f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+      f'<rect width="{size}" height="{size}" fill="#fff"/><path d="{"".join(runs)}"/></svg>'
+  )
+
+
+class WorkerError(RuntimeError):
+  """O processo renderizador morreu ou respondeu fora do protocolo."""
+
+
+class _Worker:
+  """Um processo `python qr.py`: uma linha JSON por pedido, uma por resposta."""
+
+  def __init__(self):
+    self._proc = subprocess.Popen(
+        [sys.executable, __file__],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+        encoding="utf-8",
+    )
+
+  def render(self, pix_code: str, fmt: str) -> str:
+    try:
+      self._proc.stdin.write(json.dumps([pix_code, fmt]) + "\n")
+      self._proc.stdin.flush()
+      line = self._proc.stdout.readline()
+      reply = json.loads(line) if line else None
+    except (OSError, ValueError) as exc:
+      raise WorkerError(f"Processo do QR Code falhou: {exc}") from exc
+    if not isinstance(reply, dict):
+      raise WorkerError("Processo do QR Code encerrou")
+    if "error" in reply:
+      raise ValueError(reply["error"])
+    return reply["png"]
+
+  def close(self):
+    try:
+      self._proc.kill()
+      self._proc.wait(timeout=1)
+    except (OSError, subprocess.TimeoutExpired):
+      pass
+
+
+class QRRenderer:
+  def __init__(self, fmt: str = settings.qr_format, cache_size: int = settings.qr_cache_size, workers: int = settings.qr_workers):
+    if fmt not in PNG_FORMATS:
+      log.warning("QR_FORMAT desconhecido (%s); usando png", fmt)
+      fmt = "png"
+    self.fmt = fmt
+    self.cache_size = cache_size
+    self.workers = workers
+    self._cache: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+    self._lock = threading.Lock()
+    self._idle: "queue.LifoQueue[_Worker]" = queue.LifoQueue()
+    self._spawned = 0
+
+  def _cached(self, key: Tuple[str, str]) -> Optional[str]:
+    with self._lock:
+      value = self._cache.get(key)
+      if value is not None:
+        self._cache.move_to_end(key)
+      return value
+
+  def _store(self, key: Tuple[str, str], value: str) -> str:
+    with self._lock:
+      self._cache[key] = value
+      self._cache.move_to_end(key)
+      while len(self._cache) > self.cache_size:
+        self._cache.popitem(last=False)
+    return value
+
+  def render(self, pix_code: str, fmt: Optional[str] = None) -> str:
+    """Versão síncrona (no processo atual), com cache"""
+    key = (fmt or self.fmt, pix_code)
+    return self._cached(key) or self._store(key, render_png(pix_code, key[0]))
+
+  def _acquire(self) -> _Worker:
+    """Um processo livre; abre outro enquanto houver menos de `workers`."""
+    try:
+      return self._idle.get_nowait()
+    except queue.Empty:
+      pass
+    with self._lock:
+      spawn = self._spawned < self.workers
+      if spawn:
+        self._spawned += 1
+    if not spawn:
+      return self._idle.get()
+    try:
+      return _Worker()
+    except OSError as exc:
+      with self._lock:
+        self._spawned -= 1
+      raise WorkerError(f"Não foi possível iniciar o processo do QR Code: {exc}") from exc
+
+  def _discard(self, worker: _Worker):
+    worker.close()
+    with self._lock:
+      self._spawned -= 1
+
+  def _render_in_worker(self, pix_code: str, fmt: str) -> str:
+    worker = self._acquire()
+    try:
+      value = worker.render(pix_code, fmt)
+    except WorkerError:
+      self._discard(worker)
+      raise
+    except BaseException:
+      self._idle.put(worker)
+      raise
+    self._idle.put(worker)
+    return value
+
+  async def arender(self, pix_code: str, fmt: Optional[str] = None) -> str:
+    """Renderiza fora do event loop (processos renderizadores, ou thread com QR_WORKERS=0)"""
+    key = (fmt or self.fmt, pix_code)
+    cached = self._cached(key)
+    if cached is not None:
+      return cached
+    if self.workers <= 0:
+      return self._store(key, await asyncio.to_thread(render_png, pix_code, key[0]))
+    try:
+      value = await asyncio.to_thread(self._render_in_worker, pix_code, key[0])
+    except WorkerError as exc:
+      # O processo é descartado e outro sobe no próximo pedido
+      log.warning("%s; renderizando numa thread", exc)
+      value = await asyncio.to_thread(render_png, pix_code, key[0])
+    return self._store(key, value)
+
+  def svg(self, pix_code: str) -> str:
+    key = ("svg", pix_code)
+    return self._cached(key) or self._store(key, render_svg(pix_code))
+
+
+qr_renderer = QRRenderer()
+
+
+def _serve():
+  """Laço do processo renderizador: termina quando o processo pai fecha o stdin."""
+  for line in sys.stdin:
+    try:
+      pix_code, fmt = json.loads(line)
+      reply = {"png": render_png(pix_code, fmt)}
+    except Exception as exc:
+      reply = {"error": str(exc)}
+    sys.stdout.write(json.dumps(reply) + "\n")
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+  _serve()
@@ -0,0 +1,320 @@
+"""Conciliação dos pagamentos pendentes com o gateway.
+
+Consulta o status de vários pagamentos em paralelo (com limite de
+concorrência) e respeita um prazo por varredura, para que a confirmação
+não demore mais conforme o número de pendentes cresce.
+
+Nem todo pendente é consultado a cada rodada: `PollSchedule` guarda, numa
+fila de prioridade, quando cada pagamento deve ser consultado de novo.
+Pagamentos recentes são consultados a cada poucos segundos; depois da
+janela inicial o intervalo dobra a cada consulta, e passado o prazo do
+Pix o pagamento vira `expired`.
+
+Só um processo consulta o gateway: `ReconciliationEngine` disputa um lock
+de arquivo (`data/reconcile.lock`) e apenas quem o detém roda as
+varreduras. Todos os processos, líder ou não, observam os pagamentos que
+saem da lista de pendentes e avisam os inscritos quando um deles foi pago
+(o bot entrega o link, a API atualiza quem está esperando o status).
+"""
+from __future__ import annotations
+
+import asyncio
+import heapq
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from config import settings
+from gateways import router
+from resilience import GatewayUnavailableError, is_gateway_failure
+from locks import FileLock
+from pushinpay import webhook_url
+from storage import astore, Payment
+
+log = logging.getLogger(__name__)
+
+
+def payment_age(payment: Payment, now: Optional[datetime] = None) -> float:
+  """Idade do pagamento em segundos (0 se `created_at` for inválido)."""
+  try:
+    created = datetime.fromisoformat(payment.created_at)
+  except (TypeError, ValueError):
+    return 0.0
+  return max(((now or datetime.utcnow()) - created).total_seconds(), 0.0)
+
+
+class PollSchedule:
+  """Fila de prioridade (heap) de pagamentos pendentes por próxima consulta.
+
+  Entradas antigas no heap são descartadas na retirada (`_next` guarda o
+  horário válido de cada pagamento).
+  """
+
+  def __init__(
+      self,
+      fresh_interval: float = settings.poll_fresh_interval,
+      fresh_window: float = settings.poll_fresh_window,
+      max_interval: float = settings.poll_max_interval,
+  ):
+    self.fresh_interval = fresh_interval
+    self.fresh_window = fresh_window
+    self.max_interval = max_interval
+    self._heap: List[Tuple[float, str]] = []
+    self._next: Dict[str, float] = {}
+    self._backoff: Dict[str, int] = {}
+    self._lock = threading.Lock()
+
+  def __len__(self) -> int:
+    return len(self._next)
+
+  def _push(self, payment_id: str, when: float):
+    self._next[payment_id] = when
+    heapq.heappush(self._heap, (when, payment_id))
+
+  def sync(self, pending: Dict[str, Payment], now: float, grace: float = 0.0):
+    """Agenda pendentes novos e esquece os que deixaram de estar pendentes.
+
+    Com `grace` > 0 (webhook ativo), a primeira consulta de um pagamento só
+    acontece `grace` segundos depois da criação: até lá esperamos o webhook.
+    """
+    with self._lock:
+      for payment_id, payment in pending.items():
+        if payment_id not in self._next:
+          self._push(payment_id, now + max(grace - payment_age(payment), 0.0))
+      for payment_id in list(self._next):
+        if payment_id not in pending:
+          del self._next[payment_id]
+          self._backoff.pop(payment_id, None)
+
+  def pop_due(self, now: float) -> List[str]:
+    due = []
+    with self._lock:
+      while self._heap and self._heap[0][0] <= now:
+        when, payment_id = heapq.heappop(self._heap)
+        if self._next.get(payment_id) == when:
+          due.append(payment_id)
+      return due
+
+  def next_delay(self, payment_id: str, age: float) -> float:
+    if age < self.fresh_window:
+      return self.fresh_interval
+    attempt = self._backoff.get(payment_id, 0)
+    self._backoff[payment_id] = attempt + 1
+    return min(self.fresh_interval * 2 ** (attempt + 1), self.max_interval)
+
+  def reschedule(self, payment_id: str, age: float, now: float):
+    with self._lock:
+      if payment_id in self._next:
+        self._push(payment_id, now + self.next_delay(payment_id, age))
+
+  def retry_now(self, payment_id: str, now: float):
+    with self._lock:
+      if payment_id in self._next:
+        self._push(payment_id, now)
+
+  def forget(self, payment_id: str):
+    with self._lock:
+      self._next.pop(payment_id, None)
+      self._backoff.pop(payment_id, None)
+
+
+schedule = PollSchedule()
+
+
+@dataclass
+class SweepReport:
+  pending: int = 0
+  due: int = 0
+  checked: int = 0
+  expired: int = 0
+  errors: int = 0
+  timed_out: int = 0
+  duration: float = 0.0
+  finished_at: Optional[float] = None
+  paid: List[Payment] = field(default_factory=list)
+
+  def summary(self) -> dict:
+    return {
+        "pending": self.pending,
+        "due": self.due,
+        "checked": self.checked,
+        "paid": len(self.paid),
+        "expired": self.expired,
+        "errors": self.errors,
+        "timed_out": self.timed_out,
+        "duration": round(self.duration, 3),
+        "finished_at": self.finished_at,
+    }
+
+
+# Última varredura concluída neste processo (exposta em /health)
+last_report: Optional[SweepReport] = None
+
+
+async def sweep(
+    concurrency: int = settings.reconcile_concurrency,
+    deadline: float = settings.reconcile_deadline,
+) -> SweepReport:
+  """Consulta no gateway os pendentes que estão na hora e atualiza o status.
+
+  Devolve o relatório da varredura; `report.paid` traz os pagamentos
+  confirmados nesta rodada (para quem precisa entregar o link).
+  """
+  global last_report
+  started = time.monotonic()
+  pending = {payment.payment_id: payment for payment in await astore.find_pending_payments()}
+  now = time.time()
+  grace = settings.webhook_grace_seconds if webhook_url() else 0.0
+  schedule.sync(pending, now, grace)
+  due = [pending[payment_id] for payment_id in schedule.pop_due(now) if payment_id in pending]
+  report = SweepReport(pending=len(pending), due=len(due))
+  semaphore = asyncio.Semaphore(concurrency)
+  expiry = settings.pix_expiry_minutes * 60
+
+  async def check(payment: Payment):
+    async with semaphore:
+      age = payment_age(payment)
+      try:
+        # Cada pagamento é consultado no gateway que o emitiu
+        status = await router.fetch_status(payment)
+      except Exception as exc:
+        report.errors += 1
+        transient = isinstance(exc, GatewayUnavailableError) or is_gateway_failure(exc)
+        if age >= expiry and not transient:
+          # O gateway recusa a consulta (404, credenciais removidas, id inválido):
+          # passado o prazo do Pix, a cobrança foi abandonada. Falha passageira
+          # (rede, 5xx, circuito aberto) não expira: pode ter sido paga.
+          await asyncio.shield(astore.update_payment_status(payment.payment_id, "expired"))
+          schedule.forget(payment.payment_id)
+          report.expired += 1
+          return
+        schedule.reschedule(payment.payment_id, age, time.time())
+        return
+      report.checked += 1
+      if status == "paid":
+        # shield: se o prazo estourar no meio, a gravação termina mesmo assim
+        await asyncio.shield(astore.update_payment_status(payment.payment_id, "paid"))
+        schedule.forget(payment.payment_id)
+        report.paid.append(payment)
+      elif status in ("canceled", "refunded", "expired"):
+        # O gateway já encerrou a cobrança
+        await asyncio.shield(astore.update_payment_status(payment.payment_id, status))
+        schedule.forget(payment.payment_id)
+      elif age >= expiry:
+        # Passou do prazo do Pix e a última consulta não mostrou pagamento
+        await asyncio.shield(astore.update_payment_status(payment.payment_id, "expired"))
+        schedule.forget(payment.payment_id)
+        report.expired += 1
+      else:
+        schedule.reschedule(payment.payment_id, age, time.time())
+
+  tasks = {asyncio.create_task(check(payment)): payment for payment in due}
+  if tasks:
+    _, not_done = await asyncio.wait(tasks, timeout=deadline)
+    for task in not_done:
+      task.cancel()
+      # Não chegou a ser consultado: volta para a próxima rodada
+      schedule.retry_now(tasks[task].payment_id, time.time())
+    report.timed_out = len(not_done)
+
+  report.duration = time.monotonic() - started
+  report.finished_at = time.time()
+  last_report = report
+  if due:
+    log.info(
+        "Conciliação: %s pendente(s), %s na vez, %s consultado(s), %s pago(s), %s expirado(s), "
+        "%s erro(s), %s fora do prazo em %.2fs",
+        report.pending, report.due, report.checked, len(report.paid), report.expired,
+        report.errors, report.timed_out, report.duration,
+    )
+  return report
+
+
+PaidCallback = Callable[[Payment], Awaitable[None]]
+
+
+class ReconciliationEngine:
+  """Dono único do polling de pagamentos, com lease de líder entre processos."""
+
+  def __init__(self, lease_path=settings.data_dir / "reconcile.lock", tick: float = settings.reconcile_tick):
+    self.tick_interval = tick
+    self._lease = FileLock(lease_path)
+    self.is_leader = False
+    self._subscribers: List[Tuple[PaidCallback, asyncio.AbstractEventLoop]] = []
+    self._seen_pending: Optional[Set[str]] = None
+    self._task: Optional[asyncio.Task] = None
+    self._lock = threading.Lock()
+
+  def subscribe(self, callback: PaidCallback):
+    """Inscreve `callback(payment)` no evento "pagamento pago".
+
+    Precisa ser chamado de dentro do event loop onde o callback deve rodar
+    (com `python bot.py` o bot e a API têm loops diferentes).
+    """
+    self._subscribers.append((callback, asyncio.get_running_loop()))
+
+  def start(self):
+    """Inicia o loop do engine no event loop atual (só uma vez por processo)."""
+    with self._lock:
+      if self._task is not None:
+        return
+      self._task = asyncio.get_running_loop().create_task(self._run())
+
+  async def _run(self):
+    # Memoriza os pendentes já na partida, antes da primeira varredura: o que
+    # ela (ou um webhook) confirmar até o primeiro tick também é avisado
+    try:
+      await self._publish_paid()
+    except Exception:
+      log.exception("Erro ao carregar os pagamentos pendentes")
+    while True:
+      await asyncio.sleep(self.tick_interval)
+      try:
+        await self.tick()
+      except Exception:
+        log.exception("Erro na conciliação de pagamentos")
+
+  async def tick(self):
+    if not self.is_leader:
+      self.is_leader = self._lease.acquire(blocking=False)
+      if self.is_leader:
+        log.info("Este processo assumiu a conciliação de pagamentos")
+    if self.is_leader:
+      await sweep()
+    await self._publish_paid()
+
+  async def _publish_paid(self):
+    """Emite "pago" para os pendentes que saíram da lista desde a última rodada.
+
+    Pega tanto o que este processo confirmou quanto webhooks e outros
+    processos; na primeira chamada (partida do engine) só memoriza a lista.
+    """
+    current = {payment.payment_id for payment in await astore.find_pending_payments()}
+    previous, self._seen_pending = self._seen_pending, current
+    if previous is None:
+      return
+    for payment_id in previous - current:
+      payment = await astore.get_payment(payment_id)
+      if payment is not None and payment.status == "paid":
+        self._emit(payment)
+
+  def _emit(self, payment: Payment):
+    running = asyncio.get_running_loop()
+    for callback, loop in self._subscribers:
+      if loop is running:
+        loop.create_task(_safe_call(callback, payment))
+      elif not loop.is_closed():
+        asyncio.run_coroutine_threadsafe(_safe_call(callback, payment), loop)
+
+
+async def _safe_call(callback: PaidCallback, payment: Payment):
+  try:
+    await callback(payment)
+  except Exception:
+    log.exception("Erro ao processar pagamento confirmado %s", payment.payment_id)
+
+
+engine = ReconciliationEngine()
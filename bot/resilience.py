@@ -0,0 +1,246 @@
+"""Proteções em volta das chamadas aos gateways Pix.
+
+- Circuit breaker: depois de várias falhas seguidas o gateway é dado como
+  fora do ar e as chamadas falham na hora (sem esperar o timeout) até o
+  próximo teste, `reset_timeout` segundos depois.
+- Token bucket: limita a taxa de chamadas de saída por gateway.
+- Retentativas com jitter, apenas para consultas (GET idempotentes).
+
+O estado de cada gateway aparece em `/health`.
+"""
+from __future__ import annotations
+
+import asyncio
+import random
+import threading
+import time
+from typing import Callable, Optional, Tuple
+
+import httpx
+import requests
+
+from config import settings
+
+
+class GatewayUnavailableError(Exception):
+  """O gateway não foi chamado (circuito aberto ou limite de taxa)."""
+
+  def __init__(self, message: str, retry_after: float):
+    super().__init__(message)
+    self.retry_after = retry_after
+
+
+class CircuitOpenError(GatewayUnavailableError):
+  pass
+
+
+class RateLimitedError(GatewayUnavailableError):
+  pass
+
+
+def is_gateway_failure(exc: BaseException) -> bool:
+  """Falhas que contam para o circuit breaker: rede, timeout, 5xx e 429."""
+  response = getattr(exc, "response", None)
+  status = getattr(response, "status_code", None)
+  if status is not None:
+    return status >= 500 or status == 429
+  return isinstance(exc, (requests.exceptions.RequestException, httpx.TransportError, OSError))
+
+
+class CircuitBreaker:
+  CLOSED = "closed"
+  OPEN = "open"
+  HALF_OPEN = "half_open"
+
+  def __init__(self, failure_threshold: int, reset_timeout: float):
+    self.failure_threshold = failure_threshold
+    self.reset_timeout = reset_timeout
+    self.state = self.CLOSED
+    self.failures = 0
+    self.opened_at = 0.0
+    self._probing = False
+    self._lock = threading.Lock()
+
+  def before_call(self) -> bool:
+    """Libera a chamada ou sobe `CircuitOpenError`; True se ela for o teste do meio aberto."""
+    with self._lock:
+      if self.state == self.CLOSED:
+        return False
+      remaining = self.opened_at + self.reset_timeout - time.monotonic()
+      if self.state == self.OPEN and remaining <= 0:
+        self.state = self.HALF_OPEN
+      # Meio aberto: deixa passar uma única chamada de teste
+      if self.state == self.HALF_OPEN and not self._probing:
+        self._probing = True
+        return True
+      raise CircuitOpenError("Gateway indisponível (circuito aberto)", max(remaining, 1.0))
+
+  def available(self) -> bool:
+    """Se uma chamada agora passaria: circuito fechado, ou aberto mas já na hora do teste."""
+    with self._lock:
+      if self.state == self.CLOSED:
+        return True
+      if self.state == self.OPEN:
+        return self.opened_at + self.reset_timeout <= time.monotonic()
+      return not self._probing
+
+  def record_success(self):
+    with self._lock:
+      self.state = self.CLOSED
+      self.failures = 0
+      self._probing = False
+
+  def record_failure(self):
+    with self._lock:
+      self.failures += 1
+      self._probing = False
+      if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+
+  def release_probe(self):
+    """A chamada de teste terminou sem dizer nada sobre o gateway (ex.: erro 4xx)."""
+    with self._lock:
+      self._probing = False
+
+  def snapshot(self) -> dict:
+    with self._lock:
+      return {"state": self.state, "failures": self.failures}
+
+
+class TokenBucket:
+  def __init__(self, rate: float, capacity: float):
+    self.rate = rate
+    self.capacity = capacity
+    self.tokens = capacity
+    self.updated_at = time.monotonic()
+    self._lock = threading.Lock()
+
+  def _refill(self, now: float):
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+    self.updated_at = now
+
+  def reserve(self, max_wait: float) -> float:
+    """Reserva um token e devolve quanto esperar por ele (0 = na hora).
+
+    Se a espera passaria de `max_wait`, nada é reservado e sobe
+    `RateLimitedError`.
+    """
+    if self.rate <= 0:
+      return 0.0
+    with self._lock:
+      self._refill(time.monotonic())
+      wait = max(0.0, (1 - self.tokens) / self.rate)
+      if wait > max_wait:
+        raise RateLimitedError("Limite de chamadas ao gateway atingido", wait)
+      self.tokens -= 1
+      return wait
+
+  def refund(self):
+    """Devolve um token reservado para uma chamada que não aconteceu."""
+    with self._lock:
+      self.tokens = min(self.capacity, self.tokens + 1)
+
+  def snapshot(self) -> dict:
+    with self._lock:
+      self._refill(time.monotonic())
+      return {"tokens": round(self.tokens, 2), "rate": self.rate, "capacity": self.capacity}
+
+
+class GatewayGuard:
+  """Circuit breaker + token bucket + retentativas de um gateway."""
+
+  def __init__(
+      self,
+      name: str,
+      failure_threshold: int = settings.circuit_failure_threshold,
+      reset_timeout: float = settings.circuit_reset_timeout,
+      rate: float = settings.gateway_rate_per_second,
+      burst: float = settings.gateway_rate_burst,
+      max_wait: float = settings.gateway_rate_max_wait,
+      retries: int = settings.gateway_get_retries,
+  ):
+    self.name = name
+    self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+    self.bucket = TokenBucket(rate, burst)
+    self.max_wait = max_wait
+    self.retries = retries
+
+  def _attempts(self, idempotent: bool) -> int:
+    return 1 + (self.retries if idempotent else 0)
+
+  @staticmethod
+  def _backoff(attempt: int) -> float:
+    # "Full jitter": espera aleatória até 0,2 s, 0,4 s, 0,8 s...
+    return random.uniform(0, 0.2 * 2 ** attempt)
+
+  def _record(self, exc: Optional[BaseException]):
+    if exc is None:
+      self.breaker.record_success()
+    elif is_gateway_failure(exc):
+      self.breaker.record_failure()
+    else:
+      self.breaker.release_probe()
+
+  def _admit(self) -> Tuple[float, bool]:
+    """Reserva o token antes de pedir passagem ao breaker.
+
+    Assim um `RateLimitedError` nunca deixa o teste do meio aberto
+    ocupado; se o circuito recusar, o token volta para o bucket.
+    """
+    wait = self.bucket.reserve(self.max_wait)
+    try:
+      return wait, self.breaker.before_call()
+    except CircuitOpenError:
+      self.bucket.refund()
+      raise
+
+  def call(self, fn: Callable, *args, idempotent: bool = False, **kwargs):
+    attempts = self._attempts(idempotent)
+    for attempt in range(attempts):
+      wait, probe = self._admit()
+      try:
+        time.sleep(wait)
+        result = fn(*args, **kwargs)
+      except Exception as exc:
+        self._record(exc)
+        if attempt + 1 >= attempts or not is_gateway_failure(exc):
+          raise
+        time.sleep(self._backoff(attempt))
+        continue
+      except BaseException:
+        if probe:
+          self.breaker.release_probe()
+        raise
+      self._record(None)
+      return result
+
+  async def acall(self, fn: Callable, *args, idempotent: bool = False, **kwargs):
+    attempts = self._attempts(idempotent)
+    for attempt in range(attempts):
+      wait, probe = self._admit()
+      try:
+        await asyncio.sleep(wait)
+        result = await fn(*args, **kwargs)
+      except Exception as exc:
+        self._record(exc)
+        if attempt + 1 >= attempts or not is_gateway_failure(exc):
+          raise
+        await asyncio.sleep(self._backoff(attempt))
+        continue
+      except BaseException:
+        # Cancelada (ex.: prazo da conciliação): não diz nada sobre o gateway,
+        # mas o teste do meio aberto precisa ser liberado
+        if probe:
+          self.breaker.release_probe()
+        raise
+      self._record(None)
+      return result
+
+  def snapshot(self) -> dict:
+    return {"circuit": self.breaker.snapshot(), "rate_limit": self.bucket.snapshot()}
+
+
+# Compartilhados entre as versões síncrona e assíncrona de cada cliente
+pushinpay_guard = GatewayGuard("pushinpay")
+syncpay_guard = GatewayGuard("syncpay")
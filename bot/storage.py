@@ -1,15 +1,27 @@
 from __future__ import annotations
 
+import asyncio
+import atexit
 import json
-from dataclasses import dataclass, asdict, field
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict, field, fields, replace
+from functools import partial
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 from datetime import datetime
 
+from blobs import externalize_qr
 from config import settings
+from locks import FileLock
 
+log = logging.getLogger(__name__)
 
-@dataclass
+
+@dataclass(slots=True)
 class Product:
   product_id: str
   title: str
@@ -26,7 +38,7 @@ class Product:
   category: str = "Premium"
 
 
-@dataclass
+@dataclass(slots=True)
 class Payment:
   payment_id: str
   product_id: str
@@ -41,15 +53,124 @@ class Payment:
   updated_at: str
   syncpay_id: Optional[str] = None
   secret_link: str = ""
+  # Referência da imagem do QR Code no blob store (ver blobs.py)
+  qr_ref: Optional[str] = None
+  # Gateway que emitiu o Pix (ver gateways.py); registros antigos são da PushinPay
+  gateway: str = "pushinpay"
+
+
+# Status em que o pagamento não muda mais; o resto fica no índice de abertos
+TERMINAL_STATUSES = frozenset({"paid", "canceled", "cancelled", "expired", "refunded", "failed"})
+
+PAYMENT_FIELDS = frozenset(f.name for f in fields(Payment))
+
+
+def check_payment_fields(names) -> Tuple[str, ...]:
+  names = tuple(names)
+  unknown = [name for name in names if name not in PAYMENT_FIELDS]
+  if unknown:
+    raise ValueError(f"Campos de pagamento desconhecidos: {', '.join(unknown)}")
+  return names
+
+
+def _product_from_dict(obj: Dict) -> Product:
+  # Garante que todos os campos obrigatórios existem
+  return Product(
+      product_id=obj.get("product_id", ""),
+      title=obj.get("title", ""),
+      price=float(obj.get("price", 0)),
+      currency=obj.get("currency", "BRL"),
+      description=obj.get("description", ""),
+      secret_link=obj.get("secret_link", ""),
+      media_type=obj.get("media_type", "image"),
+      media_src=obj.get("media_src"),
+      media_poster=obj.get("media_poster"),
+      benefits=obj.get("benefits", []),
+      note=obj.get("note", "Liberação imediata"),
+      lifetime_text=obj.get("lifetime_text", "Acesso vitalício incluído"),
+      category=obj.get("category", "Premium"),
+  )
+
+
+class _FileIndex:
+  """Cópia em memória de um arquivo JSON, indexada por id.
+
+  Guarda o conteúdo bruto (para regravar o arquivo sem perder registros
+  que não conseguimos interpretar) e os objetos já convertidos. Produtos
+  são convertidos na carga; pagamentos só quando alguém pede por eles
+  (projeções leem direto do conteúdo bruto). Para os pagamentos, `offset`
+  marca até onde o journal já foi aplicado, `open` guarda os ids que
+  ainda não chegaram a um status terminal e `by_gateway` leva o id da
+  transação no gateway (`syncpay_id`) ao nosso `payment_id`.
+  """
+
+  def __init__(self):
+    self.signature: Optional[Tuple[int, int]] = None
+    self.raw: Dict[str, Dict] = {}
+    self.items: Dict[str, object] = {}
+    self.offset: int = 0
+    self.open: set = set()
+    self.by_gateway: Dict[str, str] = {}
+
+  def track(self, key: str, status: Optional[str]):
+    if status in TERMINAL_STATUSES:
+      self.open.discard(key)
+    else:
+      self.open.add(key)
+
+
+def _payment_from_dict(obj: Dict) -> Payment:
+  return Payment(**obj)
 
 
 class DataStore:
-  def __init__(self, base_dir: Path = settings.data_dir):
+  """Armazenamento em arquivos JSON com cache em memória.
+
+  Os objetos ficam em dicionários indexados por id e o arquivo só é relido
+  quando seu mtime/tamanho muda, assim o bot e a API (mesmo em processos
+  separados) continuam enxergando as gravações um do outro.
+
+  Pagamentos não regravam `payments.json` a cada alteração: cada evento é
+  acrescentado como uma linha em `payments.journal` e o compactador
+  periodicamente consolida o journal no snapshot (`payments.json`). Na
+  leitura carregamos o snapshot e reaplicamos só o final do journal.
+
+  Toda escrita em disco passa por um lock de arquivo (`*.lock` em `data/`),
+  então o bot e a API podem gravar ao mesmo tempo, em threads ou processos
+  diferentes, sem perder atualizações. O lock só cobre a escrita em si
+  (um append no journal, ou reler + regravar o arquivo de produtos).
+
+  Com `commit_latency` > 0 os eventos são aplicados em memória na hora e
+  gravados em lote (group commit) por uma thread que espera até esse tempo
+  para juntar o que chegar, faz um único write + fsync e libera quem está
+  esperando em `flush()`.
+
+  Os objetos retornados são compartilhados com o cache: trate-os como
+  somente leitura e use os métodos de escrita para alterá-los.
+  """
+
+  def __init__(self, base_dir: Path = settings.data_dir,
+               commit_latency: float = settings.storage_commit_latency_ms / 1000):
     self.base_dir = base_dir
     self.products_file = self.base_dir / "products.json"
     self.payments_file = self.base_dir / "payments.json"
+    self.journal_file = self.base_dir / "payments.journal"
     self.products_file.touch(exist_ok=True)
     self.payments_file.touch(exist_ok=True)
+    self.journal_file.touch(exist_ok=True)
+    self._lock = threading.RLock()
+    self._products_lock = FileLock(self.base_dir / "products.lock")
+    self._payments_lock = FileLock(self.base_dir / "payments.lock")
+    self._products = _FileIndex()
+    self._payments = _FileIndex()
+    self._compactor: Optional[threading.Thread] = None
+    # Group commit: linhas já aplicadas em memória esperando a próxima gravação
+    self._commit_latency = commit_latency
+    self._commit_cond = threading.Condition()
+    self._unflushed: List[str] = []
+    self._enqueued_seq = 0
+    self._durable_seq = 0
+    self._writer: Optional[threading.Thread] = None
 
   def _read(self, path: Path) -> Dict:
     try:
@@ -63,98 +184,409 @@ class DataStore:
       return {}
 
   def _write(self, path: Path, data: Dict):
-    path.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
+    # Grava num temporário e troca de uma vez: leitores nunca veem o arquivo pela metade
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("w", encoding="utf-8") as fh:
+      fh.write(json.dumps(data, indent=2, ensure_ascii=False))
+      fh.flush()
+      os.fsync(fh.fileno())
+    os.replace(tmp_path, path)
 
-  # Products
-  def list_products(self) -> List[Product]:
-    raw = self._read(self.products_file)
-    items = []
-    import logging
-    log = logging.getLogger(__name__)
-    log.info(f"Lendo produtos do arquivo: {self.products_file}")
-    log.info(f"Produtos brutos encontrados: {len(raw)}")
-    for obj in raw.values():
+  @staticmethod
+  def _signature(path: Path) -> Tuple[int, int]:
+    try:
+      stat = path.stat()
+    except FileNotFoundError:
+      return (0, 0)
+    return (stat.st_mtime_ns, stat.st_size)
+
+  def _load(self, path: Path, index: _FileIndex, parse=None):
+    """Carrega o arquivo no índice; sem `parse`, os objetos ficam para depois."""
+    signature = self._signature(path)
+    raw = self._read(path)
+    items = {}
+    for key, obj in raw.items() if parse else ():
+      try:
+        items[key] = parse(obj)
+      except (TypeError, KeyError, ValueError, AttributeError) as e:
+        log.warning(f"Registro inválido em {path.name} ({key}): {e}")
+    index.raw = raw
+    index.items = items
+    index.signature = signature
+    index.offset = 0
+    index.open = set()
+    index.by_gateway = {}
+    log.info(f"{path.name} recarregado: {len(raw)} registro(s)")
+
+  def _refresh(self, path: Path, index: _FileIndex, parse) -> _FileIndex:
+    """Recarrega o índice se o arquivo mudou desde a última leitura."""
+    if self._signature(path) != index.signature:
+      self._load(path, index, parse)
+    return index
+
+  def _commit(self, path: Path, index: _FileIndex):
+    self._write(path, index.raw)
+    index.signature = self._signature(path)
+
+  def _product_index(self) -> _FileIndex:
+    return self._refresh(self.products_file, self._products, _product_from_dict)
+
+  def _payment_index(self) -> _FileIndex:
+    index = self._payments
+    journal_size = self._signature(self.journal_file)[1]
+    # Snapshot novo ou journal truncado: outro processo compactou, recomeça do snapshot
+    changed = False
+    if self._signature(self.payments_file) != index.signature or journal_size < index.offset:
+      self._load(self.payments_file, index)
+      for payment_id, obj in index.raw.items():
+        if not isinstance(obj, dict):
+          continue
+        index.track(payment_id, obj.get("status"))
+        if obj.get("syncpay_id"):
+          index.by_gateway[obj["syncpay_id"]] = payment_id
+      changed = True
+    if journal_size > index.offset:
+      self._replay(index)
+      changed = True
+    if changed:
+      # Eventos nossos ainda no buffer do group commit vêm depois de tudo que já está no disco
+      with self._commit_cond:
+        unflushed = list(self._unflushed)
+      for line in unflushed:
+        self._apply_event(index, json.loads(line))
+    return index
+
+  def _replay(self, index: _FileIndex):
+    """Aplica os eventos do journal a partir de `index.offset`."""
+    with self.journal_file.open("rb") as fh:
+      fh.seek(index.offset)
+      chunk = fh.read()
+    # Ignora uma última linha incompleta (escrita em andamento)
+    end = chunk.rfind(b"\n")
+    if end < 0:
+      return
+    for line in chunk[:end].splitlines():
+      if not line.strip():
+        continue
+      try:
+        self._apply_event(index, json.loads(line))
+      except (json.JSONDecodeError, UnicodeDecodeError, TypeError, KeyError, ValueError) as e:
+        log.warning(f"Evento inválido em {self.journal_file.name}: {e}")
+    index.offset += end + 1
+
+  @staticmethod
+  def _apply_event(index: _FileIndex, event: Dict):
+    op = event.get("op")
+    if op == "save":
+      obj = event["payment"]
+      index.raw[obj["payment_id"]] = obj
+      index.items.pop(obj["payment_id"], None)
+      index.track(obj["payment_id"], obj.get("status"))
+      if obj.get("syncpay_id"):
+        index.by_gateway[obj["syncpay_id"]] = obj["payment_id"]
+    elif op == "status":
+      payment_id = event["payment_id"]
+      obj = index.raw.get(payment_id)
+      if obj is None:
+        return
+      obj["status"] = event["status"]
+      obj["updated_at"] = event["updated_at"]
+      current = index.items.get(payment_id)
+      if current is not None:
+        index.items[payment_id] = replace(current, status=event["status"], updated_at=event["updated_at"])
+      index.track(payment_id, event["status"])
+
+  def _materialize(self, index: _FileIndex, payment_id: str) -> Optional[Payment]:
+    """Converte (e memoriza) um pagamento do conteúdo bruto."""
+    payment = index.items.get(payment_id)
+    if payment is not None:
+      return payment
+    obj = index.raw.get(payment_id)
+    if obj is None:
+      return None
+    try:
+      payment = _payment_from_dict(obj)
+    except (TypeError, AttributeError) as e:
+      log.warning(f"Registro inválido em {self.payments_file.name} ({payment_id}): {e}")
+      return None
+    index.items[payment_id] = payment
+    return payment
+
+  def _append_event(self, event: Dict):
+    line = json.dumps(event, ensure_ascii=False) + "\n"
+    self._apply_event(self._payment_index(), json.loads(line))
+    if self._commit_latency <= 0:
+      self._write_lines([line])
+      return
+    with self._commit_cond:
+      self._unflushed.append(line)
+      self._enqueued_seq += 1
+      self._start_writer()
+      self._commit_cond.notify_all()
+
+  def _write_lines(self, lines: List[str]):
+    with self._payments_lock, self.journal_file.open("ab") as fh:
+      fh.write("".join(lines).encode("utf-8"))
+      fh.flush()
+      os.fsync(fh.fileno())
+
+  def _start_writer(self):
+    if self._writer is not None:
+      return
+    self._writer = threading.Thread(target=self._writer_loop, name="payments-writer", daemon=True)
+    self._writer.start()
+    atexit.register(self.flush, 5)
+
+  def _writer_loop(self):
+    while True:
+      with self._commit_cond:
+        self._commit_cond.wait_for(lambda: self._unflushed)
+      # Espera a janela de latência para juntar as escritas que chegarem nesse meio tempo
+      time.sleep(self._commit_latency)
+      with self._commit_cond:
+        batch = list(self._unflushed)
+        seq = self._enqueued_seq
       try:
-        # Garante que todos os campos obrigatórios existem
-        product_data = {
-          "product_id": obj.get("product_id", ""),
-          "title": obj.get("title", ""),
-          "price": float(obj.get("price", 0)),
-          "currency": obj.get("currency", "BRL"),
-          "description": obj.get("description", ""),
-          "secret_link": obj.get("secret_link", ""),
-          "media_type": obj.get("media_type", "image"),
-          "media_src": obj.get("media_src"),
-          "media_poster": obj.get("media_poster"),
-          "benefits": obj.get("benefits", []),
-          "note": obj.get("note", "Liberação imediata"),
-          "lifetime_text": obj.get("lifetime_text", "Acesso vitalício incluído"),
-          "category": obj.get("category", "Premium"),
-        }
-        items.append(Product(**product_data))
-      except (TypeError, KeyError, ValueError) as e:
-        log.warning(f"Erro ao criar Product: {e}, dados: {obj}")
+        self._write_lines(batch)
+      except OSError:
+        log.exception("Erro ao gravar journal de pagamentos, tentando novamente")
+        time.sleep(1)
         continue
-    log.info(f"Produtos válidos retornados: {len(items)}")
-    return items
+      with self._commit_cond:
+        del self._unflushed[:len(batch)]
+        self._durable_seq = seq
+        self._commit_cond.notify_all()
+
+  def flush(self, timeout: Optional[float] = None) -> bool:
+    """Barreira: espera até que todas as escritas feitas até agora estejam no disco."""
+    with self._commit_cond:
+      target = self._enqueued_seq
+      return self._commit_cond.wait_for(lambda: self._durable_seq >= target, timeout)
+
+  def compact(self):
+    """Consolida o journal no snapshot `payments.json` e zera o journal.
+
+    Aproveita para tirar do snapshot os QR Codes que registros antigos
+    ainda guardam inline.
+    """
+    with self._lock, self._payments_lock:
+      # Com o lock ninguém mais grava no journal: relemos o final e só então o zeramos
+      index = self._payment_index()
+      if index.offset == 0:
+        return
+      for payment_id, obj in list(index.raw.items()):
+        if isinstance(obj, dict) and obj.get("qr_base64"):
+          payment = self._materialize(index, payment_id)
+          if payment is None:
+            continue
+          payment = externalize_qr(payment)
+          index.items[payment_id] = payment
+          index.raw[payment_id] = asdict(payment)
+      self._commit(self.payments_file, index)
+      with self.journal_file.open("wb"):
+        pass
+      index.offset = 0
+      log.info(f"Journal de pagamentos compactado: {len(index.raw)} registro(s) no snapshot")
+
+  def start_compactor(self, interval: float = settings.journal_compact_interval,
+                      threshold: int = settings.journal_compact_bytes):
+    """Inicia (uma única vez) a thread que compacta o journal quando ele passa de `threshold` bytes."""
+    if self._compactor is not None or interval <= 0:
+      return
+
+    def run():
+      while True:
+        time.sleep(interval)
+        try:
+          if self._signature(self.journal_file)[1] >= threshold:
+            self.compact()
+        except Exception:
+          log.exception("Erro ao compactar journal de pagamentos")
+
+    self._compactor = threading.Thread(target=run, name="payments-compactor", daemon=True)
+    self._compactor.start()
+
+  # Products
+  def list_products(self) -> List[Product]:
+    with self._lock:
+      return list(self._product_index().items.values())
 
   def save_product(self, product: Product):
-    data = self._read(self.products_file)
-    data[product.product_id] = asdict(product)
-    self._write(self.products_file, data)
+    with self._lock, self._products_lock:
+      index = self._product_index()
+      index.raw[product.product_id] = asdict(product)
+      index.items[product.product_id] = product
+      self._commit(self.products_file, index)
 
   def get_product(self, product_id: str) -> Optional[Product]:
-    data = self._read(self.products_file)
-    obj = data.get(product_id)
-    if not obj:
-      return None
-    return Product(**obj)
+    with self._lock:
+      return self._product_index().items.get(product_id)
 
   def delete_product(self, product_id: str):
-    data = self._read(self.products_file)
-    if product_id in data:
-      data.pop(product_id)
-      self._write(self.products_file, data)
+    with self._lock, self._products_lock:
+      index = self._product_index()
+      if product_id in index.raw:
+        index.raw.pop(product_id)
+        index.items.pop(product_id, None)
+        self._commit(self.products_file, index)
 
   # Payments
   def save_payment(self, payment: Payment):
-    data = self._read(self.payments_file)
-    data[payment.payment_id] = asdict(payment)
-    self._write(self.payments_file, data)
+    payment = externalize_qr(payment)
+    with self._lock:
+      self._append_event({"op": "save", "payment": asdict(payment)})
 
   def update_payment_status(self, payment_id: str, status: str):
-    data = self._read(self.payments_file)
-    if payment_id not in data:
-      return
-    data[payment_id]["status"] = status
-    data[payment_id]["updated_at"] = datetime.utcnow().isoformat()
-    self._write(self.payments_file, data)
+    with self._lock:
+      if payment_id not in self._payment_index().raw:
+        return
+      self._append_event({
+          "op": "status",
+          "payment_id": payment_id,
+          "status": status,
+          "updated_at": datetime.utcnow().isoformat(),
+      })
 
   def get_payment(self, payment_id: str) -> Optional[Payment]:
-    data = self._read(self.payments_file)
-    obj = data.get(payment_id)
-    if not obj:
-      return None
-    return Payment(**obj)
+    with self._lock:
+      return self._materialize(self._payment_index(), payment_id)
+
+  def get_payment_by_gateway_id(self, gateway_id: str) -> Optional[Payment]:
+    """Busca o pagamento pelo id da transação no gateway (usado pelos webhooks)."""
+    with self._lock:
+      index = self._payment_index()
+      payment_id = index.by_gateway.get(gateway_id)
+      return self._materialize(index, payment_id) if payment_id else None
 
   def find_pending_payments(self) -> List[Payment]:
-    data = self._read(self.payments_file)
-    pending = []
-    for obj in data.values():
-      if obj.get("status") == "pending":
-        pending.append(Payment(**obj))
-    return pending
+    # Percorre só o índice de pagamentos em aberto, não o histórico inteiro
+    with self._lock:
+      index = self._payment_index()
+      pending = []
+      for payment_id in index.open:
+        if index.raw[payment_id].get("status") != "pending":
+          continue
+        payment = self._materialize(index, payment_id)
+        if payment is not None:
+          pending.append(payment)
+      return pending
 
   def list_payments(self) -> List[Payment]:
-    data = self._read(self.payments_file)
-    payments: List[Payment] = []
-    for obj in data.values():
+    with self._lock:
+      index = self._payment_index()
+      payments = (self._materialize(index, payment_id) for payment_id in list(index.raw))
+      return [payment for payment in payments if payment is not None]
+
+  def project_payments(self, *names: str) -> List[tuple]:
+    """Devolve só os campos pedidos de todos os pagamentos, como tuplas.
+
+    Ex.: `store.project_payments("status", "price")`. Não cria objetos
+    `Payment`, então campos pesados (`pix_code`, `secret_link`...) não são
+    copiados.
+    """
+    names = check_payment_fields(names)
+    with self._lock:
+      return [
+          tuple(obj.get(name) for name in names)
+          for obj in self._payment_index().raw.values()
+          if isinstance(obj, dict)
+      ]
+
+
+class AsyncDataStore:
+  """Fachada assíncrona para o DataStore (JSON ou SQLite).
+
+  Cada chamada roda num pool de threads limitado, então handlers do bot e
+  endpoints da API não travam o event loop enquanto o arquivo/banco é lido
+  ou gravado.
+  """
+
+  def __init__(self, backend, max_workers: int = settings.storage_workers):
+    self.backend = backend
+    self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="storage")
+    # Muda a cada alteração do catálogo feita por este processo (ver http_cache.py)
+    self.catalog_version = 0
+    self._status_listeners: List[Callable[[str, str], None]] = []
+
+  def on_status_change(self, callback: Callable[[str, str], None]):
+    """Chama `callback(payment_id, status)` depois de cada mudança de status gravada.
+
+    O callback roda na thread de quem gravou: deve ser rápido e thread-safe.
+    """
+    self._status_listeners.append(callback)
+
+  async def _run(self, fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self._executor, partial(fn, *args))
+
+  # Products
+  async def list_products(self) -> List[Product]:
+    return await self._run(self.backend.list_products)
+
+  async def save_product(self, product: Product):
+    try:
+      return await self._run(self.backend.save_product, product)
+    finally:
+      self.catalog_version += 1
+
+  async def get_product(self, product_id: str) -> Optional[Product]:
+    return await self._run(self.backend.get_product, product_id)
+
+  async def delete_product(self, product_id: str):
+    try:
+      return await self._run(self.backend.delete_product, product_id)
+    finally:
+      self.catalog_version += 1
+
+  # Payments
+  async def save_payment(self, payment: Payment):
+    return await self._run(self.backend.save_payment, payment)
+
+  async def update_payment_status(self, payment_id: str, status: str):
+    result = await self._run(self.backend.update_payment_status, payment_id, status)
+    for callback in self._status_listeners:
       try:
-        payments.append(Payment(**obj))
-      except TypeError:
-        continue
-    return payments
+        callback(payment_id, status)
+      except Exception:
+        log.exception("Erro no aviso de mudança de status")
+    return result
+
+  async def get_payment(self, payment_id: str) -> Optional[Payment]:
+    return await self._run(self.backend.get_payment, payment_id)
+
+  async def get_payment_by_gateway_id(self, gateway_id: str) -> Optional[Payment]:
+    return await self._run(self.backend.get_payment_by_gateway_id, gateway_id)
+
+  async def find_pending_payments(self) -> List[Payment]:
+    return await self._run(self.backend.find_pending_payments)
+
+  async def list_payments(self) -> List[Payment]:
+    return await self._run(self.backend.list_payments)
+
+  async def project_payments(self, *names: str) -> List[tuple]:
+    return await self._run(self.backend.project_payments, *names)
+
+  async def flush(self, timeout: Optional[float] = None) -> bool:
+    return await self._run(self.backend.flush, timeout)
+
+
+def create_store():
+  """Cria o backend configurado em `STORAGE_BACKEND` (json ou sqlite)."""
+  if settings.storage_backend == "sqlite":
+    from storage_sqlite import SQLiteDataStore
+    return SQLiteDataStore()
+  return DataStore()
+
+
+store = create_store()
+astore = AsyncDataStore(store)
 
 
-store = DataStore()
+def start_compactor():
+  """Liga a compactação do journal (backend json).
 
+  Chamado na partida do bot e da API, nunca no import: processos que só
+  importam o módulo (scripts, renderizadores de QR) não mexem no journal.
+  """
+  if isinstance(store, DataStore):
+    store.start_compactor()
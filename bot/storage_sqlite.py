@@ -0,0 +1,219 @@
+"""Backend SQLite para o DataStore.
+
+Mesma API do `DataStore` em arquivos JSON, mas cada escrita vira uma
+atualização de linha em vez de regravar o arquivo inteiro. Ative com
+`STORAGE_BACKEND=sqlite` no `.env` e, na primeira vez, migre os dados
+existentes com:
+
+    python storage_sqlite.py
+"""
+from __future__ import annotations
+
+import json
+import logging
+import sqlite3
+import threading
+from dataclasses import asdict, fields
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+from blobs import externalize_qr
+from config import settings
+from storage import DataStore, Payment, Product, check_payment_fields
+
+log = logging.getLogger(__name__)
+
+PRODUCT_COLUMNS = [f.name for f in fields(Product)]
+PAYMENT_COLUMNS = [f.name for f in fields(Payment)]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+  product_id TEXT PRIMARY KEY,
+  title TEXT NOT NULL,
+  price REAL NOT NULL,
+  currency TEXT NOT NULL,
+  description TEXT NOT NULL,
+  secret_link TEXT NOT NULL,
+  media_type TEXT NOT NULL,
+  media_src TEXT,
+  media_poster TEXT,
+  benefits TEXT NOT NULL,
+  note TEXT NOT NULL,
+  lifetime_text TEXT NOT NULL,
+  category TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS payments (
+  payment_id TEXT PRIMARY KEY,
+  product_id TEXT NOT NULL,
+  product_title TEXT NOT NULL,
+  customer_id INTEGER NOT NULL,
+  customer_ref TEXT NOT NULL,
+  price REAL NOT NULL,
+  pix_code TEXT NOT NULL,
+  qr_base64 TEXT,
+  status TEXT NOT NULL,
+  created_at TEXT NOT NULL,
+  updated_at TEXT NOT NULL,
+  syncpay_id TEXT,
+  secret_link TEXT NOT NULL DEFAULT '',
+  qr_ref TEXT,
+  gateway TEXT NOT NULL DEFAULT 'pushinpay'
+);
+
+CREATE INDEX IF NOT EXISTS idx_payments_status ON payments (status);
+CREATE INDEX IF NOT EXISTS idx_payments_syncpay_id ON payments (syncpay_id);
+CREATE INDEX IF NOT EXISTS idx_payments_customer_id ON payments (customer_id);
+CREATE INDEX IF NOT EXISTS idx_payments_created_at ON payments (created_at);
+"""
+
+
+def _product_row(product: Product) -> tuple:
+  data = asdict(product)
+  data["benefits"] = json.dumps(data["benefits"], ensure_ascii=False)
+  return tuple(data[name] for name in PRODUCT_COLUMNS)
+
+
+def _row_to_product(row: sqlite3.Row) -> Product:
+  data = dict(row)
+  data["benefits"] = json.loads(data["benefits"] or "[]")
+  return Product(**data)
+
+
+def _payment_row(payment: Payment) -> tuple:
+  data = asdict(externalize_qr(payment))
+  return tuple(data[name] for name in PAYMENT_COLUMNS)
+
+
+def _row_to_payment(row: sqlite3.Row) -> Payment:
+  return Payment(**dict(row))
+
+
+class SQLiteDataStore:
+  """DataStore em SQLite (modo WAL), uma conexão por thread."""
+
+  def __init__(self, db_path: Optional[Path] = None):
+    self.db_path = db_path or settings.data_dir / "store.db"
+    self._local = threading.local()
+    conn = self._conn()
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    self._upgrade_schema(conn)
+
+  @staticmethod
+  def _upgrade_schema(conn: sqlite3.Connection):
+    """Adiciona colunas novas em bancos criados por versões anteriores."""
+    existing = {row["name"] for row in conn.execute("PRAGMA table_info(payments)")}
+    if "qr_ref" not in existing:
+      conn.execute("ALTER TABLE payments ADD COLUMN qr_ref TEXT")
+    if "gateway" not in existing:
+      conn.execute("ALTER TABLE payments ADD COLUMN gateway TEXT NOT NULL DEFAULT 'pushinpay'")
+
+  def _conn(self) -> sqlite3.Connection:
+    conn = getattr(self._local, "conn", None)
+    if conn is None:
+      conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+      conn.row_factory = sqlite3.Row
+      conn.execute("PRAGMA synchronous=NORMAL")
+      conn.execute("PRAGMA busy_timeout=30000")
+      self._local.conn = conn
+    return conn
+
+  # Products
+  def list_products(self) -> List[Product]:
+    rows = self._conn().execute("SELECT * FROM products ORDER BY rowid").fetchall()
+    return [_row_to_product(row) for row in rows]
+
+  def save_product(self, product: Product):
+    placeholders = ", ".join("?" for _ in PRODUCT_COLUMNS)
+    self._conn().execute(
+        f"INSERT OR REPLACE INTO products ({', '.join(PRODUCT_COLUMNS)}) VALUES ({placeholders})",
+        _product_row(product),
+    )
+
+  def get_product(self, product_id: str) -> Optional[Product]:
+    row = self._conn().execute("SELECT * FROM products WHERE product_id = ?", (product_id,)).fetchone()
+    return _row_to_product(row) if row else None
+
+  def delete_product(self, product_id: str):
+    self._conn().execute("DELETE FROM products WHERE product_id = ?", (product_id,))
+
+  # Payments
+  def save_payment(self, payment: Payment):
+    placeholders = ", ".join("?" for _ in PAYMENT_COLUMNS)
+    self._conn().execute(
+        f"INSERT OR REPLACE INTO payments ({', '.join(PAYMENT_COLUMNS)}) VALUES ({placeholders})",
+        _payment_row(payment),
+    )
+
+  def save_payments(self, payments: Iterable[Payment]):
+    """Grava vários pagamentos numa única transação (usado na migração)."""
+    placeholders = ", ".join("?" for _ in PAYMENT_COLUMNS)
+    conn = self._conn()
+    with conn:
+      conn.execute("BEGIN")
+      conn.executemany(
+          f"INSERT OR REPLACE INTO payments ({', '.join(PAYMENT_COLUMNS)}) VALUES ({placeholders})",
+          [_payment_row(payment) for payment in payments],
+      )
+
+  def update_payment_status(self, payment_id: str, status: str):
+    self._conn().execute(
+        "UPDATE payments SET status = ?, updated_at = ? WHERE payment_id = ?",
+        (status, datetime.utcnow().isoformat(), payment_id),
+    )
+
+  def get_payment(self, payment_id: str) -> Optional[Payment]:
+    row = self._conn().execute("SELECT * FROM payments WHERE payment_id = ?", (payment_id,)).fetchone()
+    return _row_to_payment(row) if row else None
+
+  def get_payment_by_gateway_id(self, gateway_id: str) -> Optional[Payment]:
+    row = self._conn().execute("SELECT * FROM payments WHERE syncpay_id = ?", (gateway_id,)).fetchone()
+    return _row_to_payment(row) if row else None
+
+  def find_pending_payments(self) -> List[Payment]:
+    rows = self._conn().execute("SELECT * FROM payments WHERE status = 'pending'").fetchall()
+    return [_row_to_payment(row) for row in rows]
+
+  def list_payments(self) -> List[Payment]:
+    rows = self._conn().execute("SELECT * FROM payments ORDER BY created_at").fetchall()
+    return [_row_to_payment(row) for row in rows]
+
+  def flush(self, timeout: Optional[float] = None) -> bool:
+    """Cada escrita já é uma transação confirmada; mantido por compatibilidade com o DataStore."""
+    return True
+
+  def project_payments(self, *names: str) -> List[tuple]:
+    """Devolve só as colunas pedidas de todos os pagamentos, como tuplas."""
+    names = check_payment_fields(names)
+    rows = self._conn().execute(f"SELECT {', '.join(names)} FROM payments").fetchall()
+    return [tuple(row) for row in rows]
+
+
+def migrate_from_json(source_dir: Path = settings.data_dir, db_path: Optional[Path] = None) -> SQLiteDataStore:
+  """Copia `products.json` e `payments.json` para o banco SQLite.
+
+  Pode ser executada mais de uma vez: registros com o mesmo id são
+  sobrescritos.
+  """
+  json_store = DataStore(source_dir)
+  sqlite_store = SQLiteDataStore(db_path)
+
+  products = json_store.list_products()
+  for product in products:
+    sqlite_store.save_product(product)
+
+  payments = json_store.list_payments()
+  sqlite_store.save_payments(payments)
+
+  log.info(f"Migração concluída: {len(products)} produto(s), {len(payments)} pagamento(s) -> {sqlite_store.db_path}")
+  return sqlite_store
+
+
+if __name__ == "__main__":
+  logging.basicConfig(
+      format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+      level=logging.INFO,
+  )
+  migrate_from_json()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Teste de estresse do DataStore com vários processos gravando ao mesmo tempo.
+
+Cada processo cria seus pagamentos, marca todos como pagos e salva um
+produto, enquanto um deles compacta o journal no meio do caminho. No fim
+conferimos que nenhuma atualização se perdeu.
+
+Uso:
+    python stress_storage.py [--writers 8] [--payments 200] [--latency-ms 5]
+"""
+from __future__ import annotations
+
+import argparse
+import multiprocessing
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from storage import DataStore, Payment, Product
+
+
+def writer(base_dir: str, worker: int, count: int, latency: float):
+  store = DataStore(Path(base_dir), commit_latency=latency)
+  now = datetime.utcnow().isoformat()
+  for i in range(count):
+    store.save_payment(Payment(
+        payment_id=f"w{worker}-{i}",
+        product_id=f"produto-{worker}",
+        product_title=f"Produto {worker}",
+        customer_id=worker,
+        customer_ref=f"w{worker}",
+        price=1.0,
+        pix_code=f"pix-{worker}-{i}",
+        qr_base64=None,
+        status="pending",
+        created_at=now,
+        updated_at=now,
+    ))
+    if worker == 0 and i % 50 == 49:
+      store.compact()
+  store.flush()
+  for i in range(count):
+    store.update_payment_status(f"w{worker}-{i}", "paid")
+  store.save_product(Product(
+      product_id=f"produto-{worker}",
+      title=f"Produto {worker}",
+      price=1.0,
+      currency="BRL",
+      description="stress",
+      secret_link="https://example.com",
+  ))
+  store.flush()
+
+
+def main() -> int:
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--writers", type=int, default=8)
+  parser.add_argument("--payments", type=int, default=200)
+  parser.add_argument("--latency-ms", type=float, default=5.0)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as base_dir:
+    started = time.perf_counter()
+    procs = [
+        multiprocessing.Process(target=writer, args=(base_dir, w, args.payments, args.latency_ms / 1000))
+        for w in range(args.writers)
+    ]
+    for proc in procs:
+      proc.start()
+    for proc in procs:
+      proc.join()
+    elapsed = time.perf_counter() - started
+
+    if any(proc.exitcode != 0 for proc in procs):
+      print("❌ Algum processo terminou com erro")
+      return 1
+
+    store = DataStore(Path(base_dir))
+    expected = args.writers * args.payments
+    statuses = [status for (status,) in store.project_payments("status")]
+    products = store.list_products()
+    ok = len(statuses) == expected and all(s == "paid" for s in statuses) and len(products) == args.writers
+
+    ops = expected * 2 + args.writers
+    print(f"Processos: {args.writers} | operações: {ops} | tempo: {elapsed:.2f}s ({ops / elapsed:.0f} ops/s)")
+    print(f"Pagamentos: {len(statuses)}/{expected} | pagos: {statuses.count('paid')} | produtos: {len(products)}/{args.writers}")
+    print("✅ Nenhuma atualização perdida" if ok else "❌ Atualizações perdidas!")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
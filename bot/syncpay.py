@@ -1,29 +1,67 @@
 from __future__ import annotations
 
-import base64
 from datetime import datetime, timedelta
 from typing import Optional
 import logging
+import threading
+import time
 
+import asyncio
+
+import httpx
 import requests
 
 from config import settings
+from gateway_http import AsyncClientPool, create_session, gateway_timeout
+from qr import qr_renderer
+from resilience import syncpay_guard
 
 log = logging.getLogger(__name__)
 
 
-class SyncPayClient:
-  def __init__(self):
-    self._token: Optional[str] = None
-    self._expires_at: Optional[datetime] = None
+class SyncPayTokenManager:
+  """Token OAuth da SyncPay compartilhado pelos clientes sync e async.
 
-  def _auth_headers(self) -> dict:
-    now = datetime.utcnow()
-    if not self._token or not self._expires_at or now >= self._expires_at:
-      self._refresh_token()
-    return {"Authorization": f"Bearer {self._token}"}
+  A renovação é single-flight: só uma thread chama o endpoint de auth e as
+  demais esperam o resultado. Uma thread de fundo renova o token
+  ``SYNCPAY_TOKEN_REFRESH_LEAD`` segundos antes de expirar, então as
+  requisições só pagam o round-trip de auth na primeira chamada (ou se a
+  renovação de fundo falhar até o token expirar de fato).
+  """
+
+  def __init__(self, session: requests.Session):
+    self._session = session
+    # (token, expira_em, renovar_em) trocados de uma vez para leitura sem lock
+    self._state: tuple[Optional[str], Optional[datetime], Optional[datetime]] = (None, None, None)
+    self._lock = threading.Lock()
+    self._thread: Optional[threading.Thread] = None
+    self._rescheduled = threading.Event()
+
+  def _valid_token(self) -> Optional[str]:
+    token, expires_at, _ = self._state
+    if token and expires_at and datetime.utcnow() < expires_at:
+      return token
+    return None
+
+  def headers(self) -> dict:
+    token = self._valid_token()
+    if token is None:
+      with self._lock:
+        token = self._valid_token()
+        if token is None:
+          token = self._refresh_token()
+      self.start()
+    return {"Authorization": f"Bearer {token}"}
+
+  async def aheaders(self) -> dict:
+    token = self._valid_token()
+    if token is not None:
+      return {"Authorization": f"Bearer {token}"}
+    # Caminho raro: a renovação roda numa thread para compartilhar o mesmo lock
+    # entre event loops e threads
+    return await asyncio.to_thread(self.headers)
 
-  def _refresh_token(self):
+  def _refresh_token(self) -> str:
     if not settings.syncpay_client_id or not settings.syncpay_client_secret:
       error_msg = "SYNCPAY_CLIENT_ID ou SYNCPAY_CLIENT_SECRET não configurados!"
       log.error(error_msg)
@@ -37,7 +75,7 @@ class SyncPayClient:
     log.info("Atualizando token SyncPay - URL: %s", settings.syncpay_auth_url)
     
     try:
-      response = requests.post(settings.syncpay_auth_url, json=payload, timeout=20)
+      response = self._session.post(settings.syncpay_auth_url, json=payload, timeout=gateway_timeout())
       log.info("Token SyncPay - Status: %s", response.status_code)
       
       if not response.ok:
@@ -45,10 +83,18 @@ class SyncPayClient:
       
       response.raise_for_status()
       data = response.json()
-      self._token = data["access_token"]
-      expires_in = data.get("expires_in", 3600)
-      self._expires_at = datetime.utcnow() + timedelta(seconds=expires_in - 60)
-      log.info("SyncPay token atualizado, expira em %s", self._expires_at)
+      token = data["access_token"]
+      expires_in = float(data.get("expires_in", 3600))
+      now = datetime.utcnow()
+      lifetime = max(expires_in - 60, 0)
+      expires_at = now + timedelta(seconds=lifetime)
+      # Tokens curtos: renova na metade da vida em vez de nunca ter folga
+      lead = min(settings.syncpay_token_refresh_lead, lifetime / 2)
+      refresh_at = now + timedelta(seconds=lifetime - lead)
+      self._state = (token, expires_at, refresh_at)
+      self._rescheduled.set()
+      log.info("SyncPay token atualizado, expira em %s", expires_at)
+      return token
     except requests.exceptions.HTTPError as e:
       log.error("Erro HTTP ao atualizar token: %s - %s", e.response.status_code, e.response.text)
       raise
@@ -56,7 +102,54 @@ class SyncPayClient:
       log.exception("Erro inesperado ao atualizar token")
       raise
 
+  def start(self):
+    """Inicia a renovação de fundo (idempotente; sem credenciais não faz nada)"""
+    if not settings.syncpay_client_id or not settings.syncpay_client_secret:
+      return
+    with self._lock:
+      if self._thread is not None and self._thread.is_alive():
+        return
+      self._thread = threading.Thread(target=self._run, name="syncpay-token", daemon=True)
+      self._thread.start()
+
+  def _run(self):
+    retry = 1.0
+    while True:
+      _, _, refresh_at = self._state
+      if refresh_at is not None:
+        wait = (refresh_at - datetime.utcnow()).total_seconds()
+        # Acorda antes se o token for renovado por outro caminho
+        if wait > 0 and self._rescheduled.wait(wait):
+          self._rescheduled.clear()
+          continue
+      try:
+        with self._lock:
+          _, _, refresh_at = self._state
+          # Outra thread pode ter renovado enquanto dormíamos
+          if refresh_at is None or datetime.utcnow() >= refresh_at:
+            self._refresh_token()
+        retry = 1.0
+      except Exception:
+        log.warning("Falha na renovação de fundo do token SyncPay; nova tentativa em %.0fs", retry)
+        time.sleep(retry)
+        retry = min(retry * 2, 60.0)
+
+
+class SyncPayClient:
+  def __init__(self, tokens: Optional[SyncPayTokenManager] = None):
+    self._session, self._adapter = create_session()
+    self._tokens = tokens or SyncPayTokenManager(self._session)
+
+  def connection_stats(self) -> dict:
+    return self._adapter.stats()
+
+  def _auth_headers(self) -> dict:
+    return self._tokens.headers()
+
   def create_pix(self, amount: float, description: str, reference_id: str) -> dict:
+    return syncpay_guard.call(self._create_pix, amount, description, reference_id)
+
+  def _create_pix(self, amount: float, description: str, reference_id: str) -> dict:
     payload = {
         "amount": amount,
         "description": description[:90],
@@ -71,11 +164,11 @@ class SyncPayClient:
       headers = self._auth_headers()
       log.info("Criando PIX - Headers (sem token): %s", {k: v[:20] + "..." if len(v) > 20 else v for k, v in headers.items()})
       
-      response = requests.post(
+      response = self._session.post(
           settings.syncpay_cashin_url,
           json=payload,
           headers=headers,
-          timeout=20,
+          timeout=gateway_timeout(),
       )
       
       log.info("Criando PIX - Status: %s", response.status_code)
@@ -105,24 +198,84 @@ class SyncPayClient:
       raise
 
   def get_transaction(self, transaction_id: str) -> dict:
+    return syncpay_guard.call(self._get_transaction, transaction_id, idempotent=True)
+
+  def _get_transaction(self, transaction_id: str) -> dict:
     url = f"{settings.syncpay_transaction_url}/{transaction_id}"
-    response = requests.get(url, headers=self._auth_headers(), timeout=20)
+    response = self._session.get(url, headers=self._auth_headers(), timeout=gateway_timeout())
     response.raise_for_status()
     return response.json()
 
   @staticmethod
   def generate_qr_base64(pix_code: str) -> str:
-    import qrcode
-    from io import BytesIO
+    return qr_renderer.render(pix_code)
+
+
+class AsyncSyncPayClient:
+  """Versão assíncrona (httpx) do SyncPayClient, com as mesmas respostas."""
+
+  def __init__(self, tokens: SyncPayTokenManager):
+    self._tokens = tokens
+    self._clients = AsyncClientPool()
+
+  def connection_stats(self) -> dict:
+    return self._clients.stats()
+
+  async def _auth_headers(self) -> dict:
+    return await self._tokens.aheaders()
+
+  async def create_pix(self, amount: float, description: str, reference_id: str) -> dict:
+    return await syncpay_guard.acall(self._create_pix, amount, description, reference_id)
+
+  async def _create_pix(self, amount: float, description: str, reference_id: str) -> dict:
+    payload = {
+        "amount": amount,
+        "description": description[:90],
+        "reference_id": reference_id,
+    }
+    log.info("Criando PIX (async) - URL: %s - Payload: %s", settings.syncpay_cashin_url, payload)
+
+    try:
+      response = await self._clients.get().post(
+          settings.syncpay_cashin_url,
+          json=payload,
+          headers=await self._auth_headers(),
+      )
+      if response.status_code == 404:
+        error_msg = (
+          f"Endpoint não encontrado (404): {settings.syncpay_cashin_url}\n"
+          f"Verifique se a URL está correta no arquivo .env\n"
+          f"URL padrão sugerida: https://syncpay.apidog.io/api/partner/v1/pix/cashin"
+        )
+        log.error(error_msg)
+        raise httpx.HTTPStatusError(error_msg, request=response.request, response=response)
 
-    qr = qrcode.QRCode(version=4, box_size=6, border=2)
-    qr.add_data(pix_code)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    buffer = BytesIO()
-    img.save(buffer, format="PNG")
-    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+      response.raise_for_status()
+      data = response.json()
+      log.info("Criando PIX - Sucesso! Transaction ID: %s", data.get("transaction_id") or data.get("id"))
+      return data
+    except httpx.HTTPStatusError as e:
+      log.error("Erro HTTP ao criar PIX: %s - %s", e.response.status_code, e.response.text[:500])
+      raise
+    except Exception:
+      log.exception("Erro inesperado ao criar PIX")
+      raise
+
+  async def get_transaction(self, transaction_id: str) -> dict:
+    return await syncpay_guard.acall(self._get_transaction, transaction_id, idempotent=True)
+
+  async def _get_transaction(self, transaction_id: str) -> dict:
+    url = f"{settings.syncpay_transaction_url}/{transaction_id}"
+    response = await self._clients.get().get(url, headers=await self._auth_headers())
+    response.raise_for_status()
+    return response.json()
+
+  @staticmethod
+  async def generate_qr_base64(pix_code: str) -> str:
+    return await qr_renderer.arender(pix_code)
 
 
 syncpay_client = SyncPayClient()
+syncpay_tokens = syncpay_client._tokens
+async_syncpay_client = AsyncSyncPayClient(syncpay_tokens)
 